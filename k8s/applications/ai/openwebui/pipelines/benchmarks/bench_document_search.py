@@ -0,0 +1,182 @@
+"""
+Measure retrieve_documents latency and throughput end to end, offline.
+
+Builds (once) a synthetic collection under --path, then drives the pipeline
+against it in embedded file:// mode with the deterministic fake embedding and,
+unless --no-rerank is given, a local HTTP stand-in for the DeepInfra reranker.
+Reports p50/p95/p99 latency and QPS at the given concurrency.
+
+Run from this directory with the pipeline requirements installed:
+
+    python bench_document_search.py [--concurrency 8] [--top-k 10] [--candidates 50]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "pipelines"))
+
+import document_search_pipeline  # noqa: E402
+from document_search_pipeline import Pipeline  # noqa: E402
+from fixtures import FakeEmbedding, build_index, make_queries  # noqa: E402
+
+RERANKER_MODEL = "stub/reranker"
+
+
+async def start_reranker_stub(latency: float) -> web.AppRunner:
+    """
+    Serve DeepInfra's inference API on a free localhost port, scoring each
+    document by the share of query words it contains.
+    """
+
+    async def inference(request: web.Request) -> web.Response:
+        payload = await request.json()
+        if latency:
+            await asyncio.sleep(latency)
+        scores = []
+        for query, document in zip(payload["queries"], payload["documents"]):
+            words = set(query.lower().split())
+            found = words & set(document.lower().split())
+            scores.append(len(found) / (len(words) or 1))
+        return web.json_response({"scores": scores})
+
+    app = web.Application(client_max_size=64 * 1024**2)
+    app.router.add_post("/v1/inference/{model:.+}", inference)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner
+
+
+def percentile(latencies: list, q: int) -> float:
+    return statistics.quantiles(latencies, n=100, method="inclusive")[q - 1]
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--path", default="/tmp/bench_qdrant")
+    parser.add_argument("--collection", default="benchmark")
+    parser.add_argument("--nodes", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument(
+        "--candidates",
+        type=int,
+        default=None,
+        help="Candidates retrieved for reranking (default: derived from top_k).",
+    )
+    parser.add_argument(
+        "--engine", choices=["llamaindex", "projected", "qdrant"], default="qdrant"
+    )
+    parser.add_argument("--no-rerank", action="store_true")
+    parser.add_argument(
+        "--reranker-latency",
+        type=float,
+        default=0.0,
+        help="Seconds the stub reranker waits before answering each request.",
+    )
+    parser.add_argument(
+        "--unique-queries",
+        type=int,
+        default=None,
+        help="Distinct queries to cycle through (default: one per request).",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Keep the query and result caches enabled.",
+    )
+    args = parser.parse_args()
+
+    # Build the collection and release the local Qdrant lock for the pipeline.
+    index = await build_index(args.path, args.collection, num_nodes=args.nodes)
+    await index.vector_store._aclient.close()
+
+    if args.candidates:
+        # The pipeline derives the candidate count from top_k within these bounds.
+        document_search_pipeline.CANDIDATES_MIN = args.candidates
+        document_search_pipeline.CANDIDATES_MAX = args.candidates
+
+    stub = None
+    if not args.no_rerank:
+        stub = await start_reranker_stub(args.reranker_latency)
+        port = stub.addresses[0][1]
+
+    pipeline = Pipeline()
+    pipeline.valves = Pipeline.Valves(
+        qdrant_url=f"file://{os.path.abspath(args.path)}",
+        qdrant_collection_name=args.collection,
+        retrieval_engine=args.engine,
+        reranker_model=None if args.no_rerank else RERANKER_MODEL,
+        deepinfra_api_key=None if args.no_rerank else "benchmark",
+        deepinfra_base_url=(
+            None if args.no_rerank else f"http://127.0.0.1:{port}/v1/inference"
+        ),
+        query_cache_size=pipeline.valves.query_cache_size if args.cache else 0,
+        result_cache_size=pipeline.valves.result_cache_size if args.cache else 0,
+    )
+    # Queries are embedded with the same fake model the collection was built with.
+    embed_model = FakeEmbedding()
+    pipeline._models.get_embedding_model = lambda valves: embed_model
+
+    queries = make_queries(args.unique_queries or args.requests, seed=2)
+
+    async def noop_emitter(event: dict) -> None:
+        pass
+
+    async def search(i: int) -> str:
+        return await pipeline.retrieve_documents(
+            queries[i % len(queries)],
+            top_k=args.top_k,
+            __metadata__={"chat_id": f"bench-{i}", "message_id": "0"},
+            __event_emitter__=noop_emitter,
+        )
+
+    # Warm up the snapshot, sparse model and HTTP pool.
+    result = await search(0)
+    if result.startswith(("Error", "An error occurred")):
+        raise SystemExit(result)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    errors = 0
+
+    async def timed(i: int) -> None:
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            result = await search(i)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if result.startswith(("Error", "An error occurred")):
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed(i) for i in range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"engine {args.engine}, top_k {args.top_k}, "
+        f"reranker {'off' if args.no_rerank else 'stub'}, "
+        f"concurrency {args.concurrency}, {args.requests} requests"
+    )
+    print(
+        f"p50 {percentile(latencies, 50):7.2f} ms, "
+        f"p95 {percentile(latencies, 95):7.2f} ms, "
+        f"p99 {percentile(latencies, 99):7.2f} ms, "
+        f"{args.requests / elapsed:7.1f} QPS, {errors} errors"
+    )
+
+    await pipeline.on_shutdown()
+    if stub:
+        await stub.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+"""
+Compare the retrieval engines on a local Qdrant collection.
+
+Builds (once) a synthetic collection under --path and times hybrid retrieval
+through each engine: the LlamaIndex retriever, the projected batch query with
+Python-side fusion, and the Qdrant Query API with server-side fusion.
+
+Run from this directory with the pipeline requirements installed:
+
+    python bench_retrieval_engines.py [--path /tmp/bench_qdrant] [--normalize]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+from llama_index.core import QueryBundle
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "pipelines"))
+
+from document_search_pipeline import (  # noqa: E402
+    build_filters,
+    normalize_collection,
+    retrieve_native,
+    retrieve_projected,
+)
+from fixtures import build_index, make_queries  # noqa: E402
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--path", default="/tmp/bench_qdrant")
+    parser.add_argument("--nodes", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=50)
+    parser.add_argument("--file-name", default=None)
+    parser.add_argument(
+        "--normalize",
+        action="store_true",
+        help="Precompute cleaned text in the payloads first.",
+    )
+    args = parser.parse_args()
+
+    index = await build_index(args.path, num_nodes=args.nodes)
+    vector_store = index.vector_store
+    if args.normalize:
+        await normalize_collection(vector_store._aclient, vector_store.collection_name)
+
+    queries = make_queries(args.queries)
+    embeddings = [index._embed_model.get_query_embedding(q) for q in queries]
+    # Encode sparse vectors up front so every engine measures retrieval only.
+    vector_store._sparse_query_fn(queries)
+
+    qdrant_filters = build_filters(args.file_name)
+
+    async def llamaindex(query, embedding):
+        retriever = index.as_retriever(
+            vector_store_query_mode="hybrid",
+            similarity_top_k=args.top_k,
+            vector_store_kwargs={"qdrant_filters": qdrant_filters},
+            use_async=True,
+        )
+        return await retriever.aretrieve(
+            QueryBundle(query_str=query, embedding=embedding)
+        )
+
+    async def projected(query, embedding):
+        return await retrieve_projected(
+            vector_store, query, embedding, args.top_k, qdrant_filters
+        )
+
+    async def native_rrf(query, embedding):
+        return await retrieve_native(
+            vector_store, query, embedding, args.top_k, qdrant_filters, "rrf"
+        )
+
+    async def native_dbsf(query, embedding):
+        return await retrieve_native(
+            vector_store, query, embedding, args.top_k, qdrant_filters, "dbsf"
+        )
+
+    for name, engine in (
+        ("llamaindex", llamaindex),
+        ("projected", projected),
+        ("qdrant (rrf)", native_rrf),
+        ("qdrant (dbsf)", native_dbsf),
+    ):
+        # Warm up caches and lazy imports.
+        await engine(queries[0], embeddings[0])
+        latencies = []
+        for query, embedding in zip(queries, embeddings):
+            start = time.perf_counter()
+            await engine(query, embedding)
+            latencies.append((time.perf_counter() - start) * 1000)
+        latencies.sort()
+        print(
+            f"{name:>14}: mean {statistics.mean(latencies):6.2f} ms, "
+            f"p50 {latencies[len(latencies) // 2]:6.2f} ms, "
+            f"p95 {latencies[int(len(latencies) * 0.95)]:6.2f} ms"
+        )
+
+    await vector_store._aclient.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
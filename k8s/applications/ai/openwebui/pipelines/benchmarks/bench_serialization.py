@@ -0,0 +1,96 @@
+"""
+Micro-benchmark of building and serializing the tool output against dicts and json.dumps.
+
+The encoder is chosen when the pipeline is imported; use --disable to compare
+the fallbacks, e.g., --disable msgspec for orjson or --disable msgspec,orjson
+for the json module.
+
+Run from this directory with the pipeline requirements installed:
+
+    python bench_serialization.py [--results 50] [--text-chars 4000]
+"""
+
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "pipelines"))
+
+
+def make_rows(rng: random.Random, count: int, chars: int) -> list:
+    alphabet = string.ascii_letters + " " * 10 + ".,\n\"'éü€"
+    return [
+        (
+            i + 1,
+            f"{rng.getrandbits(128):032x}",
+            {
+                "file_name": f"file-{i % 20}.pdf",
+                "title": f"Document {i % 20}",
+                "last_modified_date": "2024-01-01",
+                "page": i // 20 + 1,
+            },
+            "".join(rng.choice(alphabet) for _ in range(chars)),
+            rng.random(),
+        )
+        for i in range(count)
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--results", type=int, default=50)
+    parser.add_argument("--text-chars", type=int, default=4000)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--disable", default="", help="Comma-separated encoders.")
+    args = parser.parse_args()
+
+    for module in filter(None, args.disable.split(",")):
+        sys.modules[module] = None
+    import document_search_pipeline
+    from document_search_pipeline import SearchResult, serialize_results
+
+    if document_search_pipeline.msgspec is not None:
+        encoder = "msgspec"
+    elif document_search_pipeline.orjson is not None:
+        encoder = "orjson"
+    else:
+        encoder = "json"
+
+    rows = make_rows(random.Random(0), args.results, args.text_chars)
+
+    def legacy():
+        return json.dumps(
+            [
+                {"id": i, "id_": id_, "metadata": m, "text": t, "score": s}
+                for i, id_, m, t, s in rows
+            ]
+        )
+
+    def typed():
+        return serialize_results(
+            [
+                SearchResult(id=i, id_=id_, metadata=m, text=t, score=s)
+                for i, id_, m, t, s in rows
+            ]
+        )
+
+    same = json.loads(legacy()) == json.loads(typed())
+    print(f"encoder: {encoder}, same decoded output: {same}")
+
+    for name, fn in (
+        ("dicts + json.dumps", legacy),
+        (f"SearchResult + {encoder}", typed),
+    ):
+        seconds = min(timeit.repeat(fn, number=args.repeat, repeat=5))
+        print(
+            f"{name}: {seconds / args.repeat * 1000:.3f} ms per request, "
+            f"{len(fn()) / 1024:.0f} KiB"
+        )
+
+
+if __name__ == "__main__":
+    main()
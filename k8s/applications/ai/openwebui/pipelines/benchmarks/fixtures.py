@@ -0,0 +1,114 @@
+"""
+Shared fixtures for the document search benchmarks.
+
+Collections are built through get_vector_index, so points have the same
+payload layout (LlamaIndex node content plus flat metadata) and named dense
+and sparse vectors as a collection ingested for the pipeline.
+"""
+
+import hashlib
+import math
+import os
+import random
+import sys
+from typing import List
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import TextNode
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "pipelines"))
+
+from document_search_pipeline import get_vector_index  # noqa: E402
+
+WORDS = (
+    "alpha beta gamma delta epsilon zeta theta kappa lambda sigma omega "
+    "contract invoice payment schedule warranty liability termination notice "
+    "report revenue forecast budget quarter growth margin expense audit "
+    "engine turbine pressure valve sensor calibration maintenance inspection"
+).split()
+
+
+class FakeEmbedding(BaseEmbedding):
+    """
+    Deterministic bag-of-words embedding, so similar texts score similarly
+    without an embedding service.
+    """
+
+    dimensions: int = 384
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimensions
+        for word in text.lower().split():
+            digest = hashlib.blake2b(word.encode(), digest_size=8).digest()
+            vector[int.from_bytes(digest, "little") % self.dimensions] += 1.0
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+def make_text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def make_queries(count: int, seed: int = 1) -> List[str]:
+    rng = random.Random(seed)
+    return [make_text(rng, 6) for _ in range(count)]
+
+
+async def build_index(
+    path: str,
+    collection_name: str = "benchmark",
+    num_nodes: int = 2000,
+    words_per_node: int = 300,
+    num_files: int = 20,
+    seed: int = 0,
+):
+    """
+    Return a VectorStoreIndex over a local Qdrant collection at path, filling
+    the collection with synthetic nodes if it does not exist yet.
+    """
+    index = get_vector_index(
+        qdrant_url=f"file://{os.path.abspath(path)}",
+        qdrant_collection_name=collection_name,
+        embedding_model="fake",
+        embed_model=FakeEmbedding(),
+    )
+    aclient = index.vector_store._aclient
+    if not await aclient.collection_exists(collection_name):
+        rng = random.Random(seed)
+        nodes = [
+            TextNode(
+                text=make_text(rng, words_per_node),
+                metadata={
+                    "file_name": f"file-{i % num_files}.pdf",
+                    "file_type": "application/pdf",
+                    "title": f"Document {i % num_files}",
+                    # Bulky provenance metadata similar to a Docling ingest.
+                    "doc_items": [
+                        {
+                            "self_ref": f"#/texts/{i}",
+                            "label": "text",
+                            "prov": [
+                                {
+                                    "page_no": i // num_files + 1,
+                                    "bbox": [rng.random() for _ in range(4)],
+                                }
+                            ],
+                        }
+                    ],
+                },
+                excluded_embed_metadata_keys=["doc_items"],
+                excluded_llm_metadata_keys=["doc_items"],
+            )
+            for i in range(num_nodes)
+        ]
+        await index.ainsert_nodes(nodes)
+    return index
@@ -17,38 +17,100 @@ license: AGPL-3.0-or-later
 # "llama-index-embeddings-huggingface, llama-index-llms-huggingface" to the
 # requirements line above.
 #
+# Run "python document_search_pipeline.py normalize" after ingestion to
+# precompute cleaned text, page numbers and neighboring chunk IDs in the Qdrant
+# payloads, and again after upgrading to a version with a new payload schema.
+# Points that have not been normalized are cleaned at query time.
+#
+# Tool output is serialized with msgspec or orjson if either is installed
+# (add it to the requirements line above), else with the json module.
+#
+# The max_result_tokens valve counts tokens with tiktoken if installed (add
+# "tiktoken" to the requirements line above), else approximately.
+#
 # Connection caching and citation indexing use async locking, but assume a
 # single-node/worker (default). If a multi-node/worker deployment of Open WebUI
-# will call this tool from separate workers, consider modifying it to use Redis
-# for state synchronization.
+# will call this tool from separate workers, add "redis" to the requirements
+# line above and set the state_backend_url valve so that citation numbering
+# is shared across workers.
+#
+# An embedded (file://) Qdrant directory can only be opened by one process.
+# For multiple workers, set the embedded_qdrant_port valve: the first worker
+# to bind the port serves the store on localhost and the others connect to
+# it; if it goes away, the next worker to reconnect takes over. Alternatively,
+# run "python document_search_pipeline.py serve --port ..." as a dedicated
+# process. The server has no authentication and only binds to loopback.
 
+from __future__ import annotations
+
+import argparse
+import array
 import asyncio
 import codecs
+import contextlib
+import hashlib
+import ipaddress
 import json
+import logging
 import re
-from typing import Any, Callable, Optional, List, Dict
+import socket
+import sys
+import time
+import unicodedata
+from bisect import bisect_left
+from collections import OrderedDict
+from dataclasses import dataclass
+from importlib.metadata import version as package_version
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    Iterator,
+    Optional,
+    List,
+    Dict,
+    Tuple,
+    Union,
+)
 from urllib.parse import urlparse
 
 import aiohttp
-from llama_index.core import QueryBundle, VectorStoreIndex
-from llama_index.core.base.embeddings.base import BaseEmbedding
-from llama_index.core.postprocessor.llm_rerank import LLMRerank
-from llama_index.core.postprocessor.types import BaseNodePostprocessor
-from llama_index.core.schema import NodeWithScore
-from llama_index.core.vector_stores import (
-    ExactMatchFilter,
-    FilterCondition,
-    MetadataFilters,
-)
-from llama_index.vector_stores.qdrant import QdrantVectorStore
-from pydantic import BaseModel, Field
-from qdrant_client import AsyncQdrantClient
+import httpx
+from aiohttp import web
+from pydantic import BaseModel, Field, PrivateAttr
+from qdrant_client import AsyncQdrantClient, models
+from qdrant_client.http.exceptions import ResponseHandlingException
+
+# Optional faster JSON encoders for the tool output.
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if TYPE_CHECKING:
+    # LlamaIndex is imported lazily where used (or by the startup warmup).
+    from llama_index.core import QueryBundle, VectorStoreIndex
+    from llama_index.core.base.embeddings.base import BaseEmbedding
+    from llama_index.core.llms import LLM
+    from llama_index.core.postprocessor.types import BaseNodePostprocessor
+    from llama_index.core.schema import NodeWithScore, TextNode
+    from llama_index.vector_stores.qdrant import QdrantVectorStore
+
+logger = logging.getLogger(__name__)
 
 # Number of candidates to retrieve if reranking:
 CANDIDATES_PER_RESULT = 10
 CANDIDATES_MIN = 20
 CANDIDATES_MAX = 100
 
+# Maximum number of queries per batch search:
+BATCH_QUERIES_MAX = 10
+
 # Number of search results:
 RESULTS_MIN = 1
 RESULTS_DEFAULT = 5
@@ -57,65 +119,542 @@ RESULTS_MAX = 20
 # Other reranker settings:
 RERANKER_TEMPERATURE = 0
 RERANKER_MAX_TOKENS = 64
+# Approximate characters per token when truncating reranker documents:
+RERANKER_CHARS_PER_TOKEN = 4
+
+# Token budget packing of search results: tiktoken encoding used to count
+# tokens if installed, minimum tokens of text worth keeping for a trimmed
+# result, and tokens reserved for the ellipses marking a trimmed window:
+TOKENIZER_ENCODING = "cl100k_base"
+RESULT_MIN_TOKENS = 50
+RESULT_ELLIPSIS_TOKENS = 4
+
+# DeepInfra inference API used for reranking:
+DEEPINFRA_INFERENCE_URL = "https://api.deepinfra.com/v1/inference"
+
+# Seconds to cache DNS lookups for pooled HTTP connections:
+HTTP_DNS_CACHE_TTL = 300
+
+# Seconds between checks of the Qdrant collection for changes that
+# invalidate the result cache:
+COLLECTION_VERSION_TTL = 10
+
+# Seconds to keep a conversation's citation state after its last update, and
+# the maximum number of conversations kept in memory:
+CITATION_TTL = 24 * 60 * 60
+CITATION_MAX_CONVERSATIONS = 10000
+
+# Prefix of keys in the shared state backend:
+STATE_KEY_PREFIX = "document_search:"
+
+# Upper bounds (seconds) of the stage latency histogram buckets:
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Sparse model used for hybrid search:
+SPARSE_MODEL = "Qdrant/bm25"
+
+# Payload fields precomputed by the normalize command. Bump the version
+# whenever clean_text or get_metadata_page changes, or a field is added, so
+# that the command recomputes them.
+PAYLOAD_SCHEMA_KEY = "document_search_schema"
+PAYLOAD_SCHEMA_VERSION = 2
+PAYLOAD_CLEANED_TEXT_KEY = "cleaned_text"
+PAYLOAD_PAGE_KEY = "page"
+PAYLOAD_PREVIOUS_KEY = "previous_node_id"
+PAYLOAD_NEXT_KEY = "next_node_id"
+
+# Keys of the LlamaIndex NodeRelationship.PREVIOUS and NEXT relationships in
+# serialized node content:
+NODE_RELATIONSHIP_PREVIOUS = "2"
+NODE_RELATIONSHIP_NEXT = "3"
+
+# Node metadata fields returned to the LLM:
+RESULT_METADATA_FIELDS = (
+    "file_name",
+    "file_type",
+    "last_modified_date",
+    "title",
+    "total_pages",
+    "headings",
+)
+
+# Payload fields fetched by the projected and qdrant retrieval engines:
+PROJECTED_PAYLOAD_FIELDS = [
+    *RESULT_METADATA_FIELDS,
+    PAYLOAD_PAGE_KEY,
+    PAYLOAD_CLEANED_TEXT_KEY,
+    PAYLOAD_SCHEMA_KEY,
+    PAYLOAD_PREVIOUS_KEY,
+    PAYLOAD_NEXT_KEY,
+]
+
+# Payload indexes created on the collection for filtered search:
+PAYLOAD_INDEXES = {
+    "file_name": models.PayloadSchemaType.KEYWORD,
+    "file_type": models.PayloadSchemaType.KEYWORD,
+    "last_modified_date": models.PayloadSchemaType.DATETIME,
+}
+
+# Weight of dense vs. sparse scores in hybrid search (LlamaIndex default):
+HYBRID_ALPHA = 0.5
 
 
-class DeepInfraReranker(BaseNodePostprocessor):
+class HTTPSessionPool:
     """
-    Reranker using DeepInfra's reranking API.
+    Long-lived aiohttp session with a pooled keep-alive connector.
+
+    The session is created lazily inside the running event loop and recreated
+    after close().
     """
 
-    top_n: int = Field(description="Number of top results to return")
-    model_id: str = Field(description="DeepInfra reranker model ID")
-    api_token: str = Field(description="DeepInfra API token")
-    instruction: Optional[str] = Field(
-        default=None,
-        description="Instruction for the reranker model",
-    )
+    def __init__(
+        self,
+        limit: int = 100,
+        keepalive_timeout: float = 30.0,
+        request_timeout: float = 60.0,
+    ) -> None:
+        self._settings = (limit, keepalive_timeout, request_timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
 
-    @classmethod
-    def class_name(cls) -> str:
-        return "DeepInfraReranker"
+    def get_session(self) -> aiohttp.ClientSession:
+        """
+        Return the shared session, creating it if needed.
+        """
+        if self._session is None or self._session.closed:
+            limit, keepalive_timeout, request_timeout = self._settings
+            connector = aiohttp.TCPConnector(
+                limit=limit,
+                keepalive_timeout=keepalive_timeout,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=request_timeout),
+            )
+        return self._session
 
-    def _postprocess_nodes(
-        self,
-        nodes: List[NodeWithScore],
-        query_bundle: Optional[QueryBundle] = None,
-    ) -> List[NodeWithScore]:
+    async def close(self) -> None:
+        """
+        Close the shared session and its pooled connections.
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries also expire after a time-to-live.
+
+    Counts hits, misses and evictions (including expirations) so the cache
+    can be sized. A maxsize of 0 disables caching.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is not None:
+            expires_at, value = item
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+            self.evictions += 1
+        self.misses += 1
+        return default
+
+    def set(self, key: Any, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def configure(self, maxsize: int, ttl: float) -> None:
+        """
+        Resize the cache and change the TTL of new entries.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        while len(self._data) > max(maxsize, 0):
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def expire(self) -> None:
+        """
+        Drop expired entries from the least recently used end.
+        """
+        now = time.monotonic()
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            del self._data[key]
+            self.evictions += 1
+
+    def items(self) -> Iterator[tuple]:
+        """
+        Iterate over (key, value) pairs, including expired entries.
+        """
+        for key, (_, value) in self._data.items():
+            yield key, value
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class StateBackend:
+    """
+    Conversation state and cache storage shared by all requests.
+
+    Subclasses must implement claim_citation and is_cited, and may batch
+    claim_citations. The default get_many/set_many store nothing, for
+    backends that are not shared between workers.
+    """
+
+    shared = False
+
+    async def claim_citation(self, conversation: str, node_id: str) -> Optional[int]:
+        """
+        Atomically assign the next citation ID of the conversation to the
+        node, or return None if the node was already cited.
+        """
         raise NotImplementedError
 
-    async def _apostprocess_nodes(
-        self,
-        nodes: List[NodeWithScore],
-        query_bundle: Optional[QueryBundle] = None,
-    ) -> List[NodeWithScore]:
+    async def claim_citations(
+        self, conversation: str, node_ids: List[str]
+    ) -> List[Optional[int]]:
         """
-        Rerank nodes using DeepInfra API.
+        Claim citation IDs for the nodes in order, as claim_citation does.
+
+        Backends with a round trip per claim should override this to claim
+        all nodes at once.
         """
-        if not nodes:
-            return []
+        return [
+            await self.claim_citation(conversation, node_id) for node_id in node_ids
+        ]
+
+    async def is_cited(self, conversation: str, node_ids: List[str]) -> List[bool]:
+        """
+        Return whether each node was already cited in the conversation.
+        """
+        raise NotImplementedError
 
-        query_str = getattr(query_bundle, "query_str", "")
-        if not query_str:
-            return nodes[: self.top_n]
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        return [None] * len(keys)
 
-        # Prepare documents for reranking
-        documents = [node.get_content() for node in nodes]
-        queries = [query_str] * len(documents)
+    async def set_many(self, items: Dict[str, bytes], ttl: float) -> None:
+        pass
 
-        # Call DeepInfra API
-        url = f"https://api.deepinfra.com/v1/inference/{self.model_id}"
-        headers = {
-            "Authorization": f"bearer {self.api_token}",
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "queries": queries,
-            "documents": documents,
+    def stats(self) -> Dict[str, float]:
+        """
+        Return gauges to export as metrics.
+        """
+        return {}
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryStateBackend(StateBackend):
+    """
+    In-process state backend (default), for single-worker deployments.
+
+    Each conversation keeps the 64-bit hashes of its cited node IDs in a
+    sorted array (8 bytes per citation), and the number of citations is the
+    array length. Conversations idle for longer than ttl are evicted, as are
+    the least recently used ones beyond maxsize.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = CITATION_MAX_CONVERSATIONS,
+        ttl: float = CITATION_TTL,
+    ) -> None:
+        self._citations = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    @staticmethod
+    def _hash(node_id: str) -> int:
+        # Collisions are negligible at 64 bits for the citations of one chat.
+        digest = hashlib.blake2b(node_id.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little")
+
+    async def claim_citation(self, conversation: str, node_id: str) -> Optional[int]:
+        # No await between the check and the update, so this is atomic
+        # within the event loop.
+        self._citations.expire()
+        cited = self._citations.get(conversation)
+        if cited is None:
+            cited = array.array("Q")
+        node_hash = self._hash(node_id)
+        i = bisect_left(cited, node_hash)
+        citation_id = None
+        if i == len(cited) or cited[i] != node_hash:
+            cited.insert(i, node_hash)
+            citation_id = len(cited)
+        # Setting again restarts the conversation's idle timer.
+        self._citations.set(conversation, cited)
+        return citation_id
+
+    async def is_cited(self, conversation: str, node_ids: List[str]) -> List[bool]:
+        cited = self._citations.get(conversation)
+        if cited is None:
+            return [False] * len(node_ids)
+        result = []
+        for node_id in node_ids:
+            node_hash = self._hash(node_id)
+            i = bisect_left(cited, node_hash)
+            result.append(i < len(cited) and cited[i] == node_hash)
+        return result
+
+    def stats(self) -> Dict[str, float]:
+        memory = 0
+        for conversation, cited in self._citations.items():
+            # Key, array, and roughly the entry tuple and ordered dict slot.
+            memory += sys.getsizeof(conversation) + sys.getsizeof(cited) + 160
+        return {
+            "citation_conversations": len(self._citations),
+            "citation_memory_bytes": memory,
         }
-        if self.instruction:
-            payload["instruction"] = self.instruction
 
-        async with aiohttp.ClientSession() as session:
+
+class RedisStateBackend(StateBackend):
+    """
+    State backend on Redis (or any server speaking the Redis protocol), so
+    that citation numbering and the query cache are shared across workers.
+
+    Requires the redis package (add "redis" to the requirements line).
+    """
+
+    shared = True
+
+    # Claims node IDs (ARGV[2:]) in the conversation's hash (KEYS[1]) and
+    # refreshes its TTL (ARGV[1]) in one atomic step. Returns the new citation
+    # ID of each node, or nil (false) for nodes already cited.
+    CLAIM_SCRIPT = """
+local key = KEYS[1]
+local citation_ids = {}
+for i = 2, #ARGV do
+    if redis.call("HEXISTS", key, ARGV[i]) == 1 then
+        citation_ids[i - 1] = false
+    else
+        local citation_id = redis.call("HINCRBY", key, "#count", 1)
+        redis.call("HSET", key, ARGV[i], citation_id)
+        citation_ids[i - 1] = citation_id
+    end
+end
+redis.call("EXPIRE", key, ARGV[1])
+return citation_ids
+"""
+
+    def __init__(self, url: str, citation_ttl: float = CITATION_TTL) -> None:
+        import redis.asyncio as redis
+
+        self._redis = redis.from_url(url)
+        self._citation_ttl = int(citation_ttl)
+        self._claim_script = self._redis.register_script(self.CLAIM_SCRIPT)
+
+    async def claim_citation(self, conversation: str, node_id: str) -> Optional[int]:
+        [citation_id] = await self.claim_citations(conversation, [node_id])
+        return citation_id
+
+    async def claim_citations(
+        self, conversation: str, node_ids: List[str]
+    ) -> List[Optional[int]]:
+        if not node_ids:
+            return []
+        key = f"{STATE_KEY_PREFIX}citations:{conversation}"
+        return await self._claim_script(
+            keys=[key], args=[self._citation_ttl, *node_ids]
+        )
+
+    async def is_cited(self, conversation: str, node_ids: List[str]) -> List[bool]:
+        if not node_ids:
+            return []
+        key = f"{STATE_KEY_PREFIX}citations:{conversation}"
+        return [value is not None for value in await self._redis.hmget(key, node_ids)]
+
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        if not keys:
+            return []
+        return await self._redis.mget([STATE_KEY_PREFIX + key for key in keys])
+
+    async def set_many(self, items: Dict[str, bytes], ttl: float) -> None:
+        if not items:
+            return
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for key, value in items.items():
+                pipe.set(STATE_KEY_PREFIX + key, value, ex=int(ttl))
+            await pipe.execute()
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+def get_state_backend(url: Optional[str] = None) -> StateBackend:
+    """
+    Return a Redis state backend for a redis:// URL, else the in-memory one.
+    """
+    if url:
+        return RedisStateBackend(url)
+    return MemoryStateBackend()
+
+
+_reranker_classes: Dict[str, type] = {}
+
+
+def get_reranker_classes() -> Dict[str, type]:
+    """
+    Define the LlamaIndex reranker postprocessors on first use, so that
+    importing this module does not import LlamaIndex.
+    """
+    if _reranker_classes:
+        return _reranker_classes
+
+    from llama_index.core.postprocessor.types import BaseNodePostprocessor
+
+    class DeepInfraReranker(BaseNodePostprocessor):
+        """
+        Reranker using DeepInfra's reranking API.
+        """
+
+        top_n: int = Field(description="Number of top results to return")
+        model_id: str = Field(description="DeepInfra reranker model ID")
+        api_token: str = Field(description="DeepInfra API token")
+        instruction: Optional[str] = Field(
+            default=None,
+            description="Instruction for the reranker model",
+        )
+        max_document_tokens: Optional[int] = Field(
+            default=None,
+            description="Approximate token budget to truncate each document to",
+        )
+        batch_size: int = Field(
+            default=CANDIDATES_MAX,
+            description="Maximum number of documents per API request",
+        )
+        base_url: str = Field(
+            default=DEEPINFRA_INFERENCE_URL,
+            description="DeepInfra inference API base URL",
+        )
+
+        _http_pool: Optional[HTTPSessionPool] = PrivateAttr(default=None)
+
+        def __init__(self, http_pool: Optional[HTTPSessionPool] = None, **kwargs: Any):
+            super().__init__(**kwargs)
+            self._http_pool = http_pool
+
+        @classmethod
+        def class_name(cls) -> str:
+            return "DeepInfraReranker"
+
+        def _postprocess_nodes(
+            self,
+            nodes: List[NodeWithScore],
+            query_bundle: Optional[QueryBundle] = None,
+        ) -> List[NodeWithScore]:
+            raise NotImplementedError
+
+        async def _apostprocess_nodes(
+            self,
+            nodes: List[NodeWithScore],
+            query_bundle: Optional[QueryBundle] = None,
+        ) -> List[NodeWithScore]:
+            """
+            Rerank nodes using DeepInfra API.
+            """
+            if not nodes:
+                return []
+
+            query_str = getattr(query_bundle, "query_str", "")
+            if not query_str:
+                return nodes[: self.top_n]
+
+            # Prepare documents for reranking: truncate each to the token budget
+            # and send identical texts only once.
+            documents = []
+            document_positions = {}
+            positions = []
+            for node in nodes:
+                text = node.get_content()
+                if self.max_document_tokens:
+                    text = text[: self.max_document_tokens * RERANKER_CHARS_PER_TOKEN]
+                if text not in document_positions:
+                    document_positions[text] = len(documents)
+                    documents.append(text)
+                positions.append(document_positions[text])
+
+            # Split large candidate sets into concurrent sub-batches.
+            batches = [
+                documents[i : i + self.batch_size]
+                for i in range(0, len(documents), self.batch_size)
+            ]
+            if self._http_pool:
+                # Reuse pooled keep-alive connections across rerank calls.
+                session = self._http_pool.get_session()
+                batch_scores = await asyncio.gather(
+                    *(self._score(session, query_str, batch) for batch in batches)
+                )
+            else:
+                async with aiohttp.ClientSession() as session:
+                    batch_scores = await asyncio.gather(
+                        *(self._score(session, query_str, batch) for batch in batches)
+                    )
+            document_scores = [score for scores in batch_scores for score in scores]
+            scores = [document_scores[position] for position in positions]
+
+            # Pair nodes with scores and sort by score (descending)
+            scored_nodes = list(zip(nodes, scores))
+            scored_nodes.sort(key=lambda x: x[1], reverse=True)
+
+            # Return top_n nodes with updated scores
+            reranked_nodes = []
+            for node, score in scored_nodes[: self.top_n]:
+                node.score = score
+                reranked_nodes.append(node)
+
+            return reranked_nodes
+
+        async def _score(
+            self, session: aiohttp.ClientSession, query_str: str, documents: List[str]
+        ) -> List[float]:
+            """
+            Score one batch of documents against the query using DeepInfra API.
+            """
+            url = f"{self.base_url.rstrip('/')}/{self.model_id}"
+            headers = {
+                "Authorization": f"bearer {self.api_token}",
+                "Content-Type": "application/json",
+            }
+            payload = {
+                "queries": [query_str] * len(documents),
+                "documents": documents,
+            }
+            if self.instruction:
+                payload["instruction"] = self.instruction
+
             async with session.post(url, headers=headers, json=payload) as response:
                 if not response.ok:
                     error_text = await response.text()
@@ -124,23 +663,96 @@ class DeepInfraReranker(BaseNodePostprocessor):
                     )
                 result = await response.json()
 
-        scores = result.get("scores", [])
-        if len(scores) != len(nodes):
-            raise RuntimeError(
-                f"DeepInfra returned {len(scores)} scores for {len(nodes)} documents"
+            scores = result.get("scores", [])
+            if len(scores) != len(documents):
+                raise RuntimeError(
+                    f"DeepInfra returned {len(scores)} scores for {len(documents)} documents"
+                )
+            return scores
+
+    class CrossEncoderReranker(BaseNodePostprocessor):
+        """
+        Reranker using a local cross-encoder model with batched CPU inference.
+        """
+
+        top_n: int = Field(description="Number of top results to return")
+        batch_size: int = Field(
+            default=CANDIDATES_MAX,
+            description="Number of query/document pairs scored per inference batch",
+        )
+
+        _model: Any = PrivateAttr(default=None)
+
+        def __init__(self, model: Any, **kwargs: Any):
+            super().__init__(**kwargs)
+            self._model = model
+
+        @classmethod
+        def class_name(cls) -> str:
+            return "CrossEncoderReranker"
+
+        def _postprocess_nodes(
+            self,
+            nodes: List[NodeWithScore],
+            query_bundle: Optional[QueryBundle] = None,
+        ) -> List[NodeWithScore]:
+            """
+            Rerank nodes by scoring query/document pairs with the cross-encoder.
+            """
+            if not nodes:
+                return []
+
+            query_str = getattr(query_bundle, "query_str", "")
+            if not query_str:
+                return nodes[: self.top_n]
+
+            documents = [node.get_content() for node in nodes]
+            scores = self._model.rerank(
+                query_str, documents, batch_size=self.batch_size
             )
 
-        # Pair nodes with scores and sort by score (descending)
-        scored_nodes = list(zip(nodes, scores))
-        scored_nodes.sort(key=lambda x: x[1], reverse=True)
+            # Pair nodes with scores and sort by score (descending)
+            scored_nodes = list(zip(nodes, scores))
+            scored_nodes.sort(key=lambda x: x[1], reverse=True)
+
+            # Return top_n nodes with updated scores
+            reranked_nodes = []
+            for node, score in scored_nodes[: self.top_n]:
+                node.score = float(score)
+                reranked_nodes.append(node)
+
+            return reranked_nodes
+
+        async def _apostprocess_nodes(
+            self,
+            nodes: List[NodeWithScore],
+            query_bundle: Optional[QueryBundle] = None,
+        ) -> List[NodeWithScore]:
+            # Run inference in a worker thread to keep the event loop responsive.
+            return await asyncio.to_thread(self._postprocess_nodes, nodes, query_bundle)
+
+    _reranker_classes.update(
+        DeepInfraReranker=DeepInfraReranker,
+        CrossEncoderReranker=CrossEncoderReranker,
+    )
+    return _reranker_classes
+
+
+def import_llama_index() -> None:
+    """
+    Import the LlamaIndex modules used at query time, e.g., during warmup.
+    """
+    import llama_index.core  # noqa: F401
+    import llama_index.vector_stores.qdrant  # noqa: F401
+
+    get_reranker_classes()
 
-        # Return top_n nodes with updated scores
-        reranked_nodes = []
-        for node, score in scored_nodes[: self.top_n]:
-            node.score = score
-            reranked_nodes.append(node)
 
-        return reranked_nodes
+def __getattr__(name: str) -> Any:
+    # Lazily defined classes, e.g., document_search_pipeline.DeepInfraReranker.
+    if name in ("DeepInfraReranker", "CrossEncoderReranker"):
+        return get_reranker_classes()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def get_embedding_model(
@@ -184,38 +796,73 @@ def get_embedding_model(
         )
 
 
-def get_reranker(
-    top_n: int,
+def get_reranker_llm(
     reranker_model_name: str,
     ollama_base_url: Optional[str] = None,
-    deepinfra_api_key: Optional[str] = None,
-) -> BaseNodePostprocessor:
+) -> LLM:
     """
-    Initialize and return the model for reranking.
+    Initialize and return the LLM used for LLM-based reranking.
     """
     if ollama_base_url:
         from llama_index.llms.ollama import Ollama
 
-        llm = Ollama(
+        return Ollama(
             model=reranker_model_name,
             base_url=ollama_base_url,
             temperature=RERANKER_TEMPERATURE,
             additional_kwargs={"num_predict": RERANKER_MAX_TOKENS},
         )
-    elif deepinfra_api_key:
-        return DeepInfraReranker(
-            top_n=top_n,
-            model_id=reranker_model_name,
-            api_token=deepinfra_api_key,
-        )
     else:
         from llama_index.llms.huggingface import HuggingFaceLLM
 
-        llm = HuggingFaceLLM(
+        return HuggingFaceLLM(
             model_name=reranker_model_name,
             max_new_tokens=RERANKER_MAX_TOKENS,
             generate_kwargs={"temperature": RERANKER_TEMPERATURE},
         )
+
+
+def get_cross_encoder(model_name: str, threads: Optional[int] = None) -> Any:
+    """
+    Initialize and return a local cross-encoder model for reranking.
+    """
+    from fastembed.rerank.cross_encoder import TextCrossEncoder
+
+    return TextCrossEncoder(model_name=model_name, threads=threads)
+
+
+def get_reranker(
+    top_n: int,
+    reranker_model_name: str,
+    ollama_base_url: Optional[str] = None,
+    deepinfra_api_key: Optional[str] = None,
+    http_pool: Optional[HTTPSessionPool] = None,
+    llm: Optional[LLM] = None,
+    max_document_tokens: Optional[int] = None,
+    batch_size: int = CANDIDATES_MAX,
+    deepinfra_base_url: Optional[str] = None,
+) -> BaseNodePostprocessor:
+    """
+    Initialize and return the model for reranking.
+    Pass a prebuilt llm to reuse it instead of constructing a new one.
+    """
+    if deepinfra_api_key and not ollama_base_url:
+        return get_reranker_classes()["DeepInfraReranker"](
+            top_n=top_n,
+            model_id=reranker_model_name,
+            api_token=deepinfra_api_key,
+            http_pool=http_pool,
+            max_document_tokens=max_document_tokens,
+            batch_size=batch_size,
+            base_url=deepinfra_base_url or DEEPINFRA_INFERENCE_URL,
+        )
+    if llm is None:
+        llm = get_reranker_llm(
+            reranker_model_name=reranker_model_name,
+            ollama_base_url=ollama_base_url,
+        )
+    from llama_index.core.postprocessor.llm_rerank import LLMRerank
+
     return LLMRerank(top_n=top_n, llm=llm)
 
 
@@ -227,14 +874,22 @@ def get_vector_index(
     ollama_base_url: Optional[str] = None,
     deepinfra_api_key: Optional[str] = None,
     qdrant_api_key: Optional[str] = None,
+    embed_model: Optional[BaseEmbedding] = None,
+    aclient: Optional[AsyncQdrantClient] = None,
 ) -> VectorStoreIndex:
     """
     Initialize and return the VectorStoreIndex object.
+    Pass a prebuilt embed_model to reuse it instead of constructing a new one.
+    Pass an already open aclient to share an embedded (file://) store.
     """
+    from llama_index.core import VectorStoreIndex
+    from llama_index.vector_stores.qdrant import QdrantVectorStore
+
     # Connect to the existing Qdrant vector store.
     parsed_url = urlparse(qdrant_url, scheme="file")
     if parsed_url.scheme == "file":
-        aclient = AsyncQdrantClient(path=parsed_url.path)
+        if aclient is None:
+            aclient = AsyncQdrantClient(path=parsed_url.path)
         kwargs = {"aclient": aclient}
         # Workaround for https://github.com/run-llama/llama_index/issues/20002
         QdrantVectorStore.use_old_sparse_encoder = lambda self, collection_name: False
@@ -244,16 +899,17 @@ def get_vector_index(
     vector_store = QdrantVectorStore(
         collection_name=qdrant_collection_name,
         enable_hybrid=True,
-        fastembed_sparse_model="Qdrant/bm25",
+        fastembed_sparse_model=SPARSE_MODEL,
         **kwargs,
     )
 
-    embed_model = get_embedding_model(
-        embedding_model_name=embedding_model,
-        embedding_query_instruction=embedding_query_instruction,
-        ollama_base_url=ollama_base_url,
-        deepinfra_api_key=deepinfra_api_key,
-    )
+    if embed_model is None:
+        embed_model = get_embedding_model(
+            embedding_model_name=embedding_model,
+            embedding_query_instruction=embedding_query_instruction,
+            ollama_base_url=ollama_base_url,
+            deepinfra_api_key=deepinfra_api_key,
+        )
 
     # Create the index object from the existing vector store.
     index = VectorStoreIndex.from_vector_store(
@@ -263,158 +919,1654 @@ def get_vector_index(
     return index
 
 
-def build_filters(file_name: str) -> MetadataFilters:
+def normalize_query(query: str) -> str:
     """
-    Build a LlamaIndex MetadataFilters object to filter by filename.
+    Normalize a query for cache lookups: Unicode NFKC and collapsed whitespace.
     """
-    return MetadataFilters(
-        filters=[ExactMatchFilter(key="file_name", value=file_name)],
-        condition=FilterCondition.AND,
-    )
+    return " ".join(unicodedata.normalize("NFKC", query).split())
 
 
-def get_node_page(node: NodeWithScore) -> Optional[int]:
-    """
-    Return page number of Node.
+def cache_sparse_queries(vector_store: QdrantVectorStore, cache: TTLCache) -> None:
     """
-    page = node.metadata.get("page") or node.metadata.get("source")
-    if not page:
-        try:
-            page = node.metadata["doc_items"][0]["prov"][0]["page_no"]
-        except Exception:
-            pass
-    return page
-
-
-def clean_text(text: str) -> str:
+    Wrap the vector store's sparse (BM25) query encoder with a cache.
     """
-    Remove unwanted formatting and artifacts from text output.
+    sparse_query_fn = vector_store._sparse_query_fn
+
+    def cached_sparse_query_fn(texts: List[str]) -> tuple:
+        keys = [("sparse", SPARSE_MODEL, normalize_query(text)) for text in texts]
+        vectors = [cache.get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            indices, values = sparse_query_fn([texts[i] for i in missing])
+            for i, vector in zip(missing, zip(indices, values)):
+                vectors[i] = vector
+                cache.set(keys[i], vector)
+        return [vector[0] for vector in vectors], [vector[1] for vector in vectors]
+
+    vector_store._sparse_query_fn = cached_sparse_query_fn
+
+
+async def rerank_in_waves(
+    nodes: List[NodeWithScore],
+    query: str,
+    top_k: int,
+    get_ranker: Callable[[int], BaseNodePostprocessor],
+    wave_size: int,
+    min_hybrid_score: Optional[float] = None,
+) -> List[NodeWithScore]:
     """
-    # Remove HTML tags.
-    text = re.sub(r"<[a-zA-Z/][^>]*>", "", text)
-    # Replace multiple blank lines with a single blank line.
-    text = re.sub(r"\n\s*\n\s*\n+", "\n\n", text)
-    # Remove lines with only whitespace.
-    text = re.sub(r"^\s*$", "", text, flags=re.MULTILINE)
-    # Remove excessive whitespace within lines.
-    text = re.sub(r" +", " ", text)
-    # Replace 4 or more periods with just 3 periods.
-    text = re.sub(r"\.{4,}", "...", text)
-    # Remove backticks.
-    # Unclosed backticks seem to cause issues with citation rendering.
-    text = text.replace("`", "")
-    # Remove citation references.
-    # Workaround for https://github.com/open-webui/open-webui/issues/17062
-    # with updated regular expression for Open WebUI 0.6.33.
-    text = re.sub(r"\[[\d,\s]+\]", "", text)
-    # Strip leading/trailing whitespace.
-    return text.strip()
+    Rerank candidates in waves ordered by hybrid score, stopping early.
 
-
-def clean_node(node: NodeWithScore, citation_id: int) -> dict:
+    The first wave (at least top_k candidates) is always reranked. Stops
+    once a wave leaves the top_k set unchanged, or when the remaining
+    candidates' hybrid scores fall below min_hybrid_score.
     """
-    Remove internal LlamaIndex node attributes.
+    candidates = sorted(nodes, key=lambda node: node.score or 0.0, reverse=True)
+    wave_size = max(wave_size, top_k)
+    reranked = []
+    top_ids = None
+    for start in range(0, len(candidates), wave_size):
+        wave = candidates[start : start + wave_size]
+        if min_hybrid_score is not None and start > 0:
+            wave = [node for node in wave if (node.score or 0.0) >= min_hybrid_score]
+            if not wave:
+                break
+        ranker = get_ranker(len(wave))
+        reranked.extend(await ranker.apostprocess_nodes(wave, query_str=query))
+        reranked.sort(key=lambda node: node.score or 0.0, reverse=True)
+        wave_top_ids = {node.node.node_id for node in reranked[:top_k]}
+        if wave_top_ids == top_ids:
+            break
+        top_ids = wave_top_ids
+    return reranked[:top_k]
+
+
+class ModelRegistry:
     """
-    metadata_fields_to_keep = {
-        "file_name",
-        "file_type",
-        "last_modified_date",
-        "title",
-        "total_pages",
-        "headings",
-    }
-    cleaned_node = {
-        "id": citation_id,
-        "id_": node.id_,
-        "metadata": {
-            k: v for k, v in node.metadata.items() if k in metadata_fields_to_keep
-        },
-        "text": clean_text(node.text),
-        "score": node.score,
-    }
-    page = get_node_page(node)
-    if page:
-        cleaned_node["metadata"]["page"] = page
-    return cleaned_node
+    Cache of embedding and reranker models keyed by the valves that configure them.
 
+    Models are rebuilt only when their relevant valves change, so the per-query
+    cost is inference rather than construction (or reloading model weights).
+    Building may load model weights, so snapshots build their models in a
+    thread and requests use the models held by their snapshot.
+    """
 
-class CitationIndex:
     def __init__(self) -> None:
-        self._set = set()
-        self._count = 0
-        self._lock = asyncio.Lock()
+        self._embed_model: Optional[BaseEmbedding] = None
+        self._embed_key: Optional[tuple] = None
+        self._reranker_model: Any = None
+        self._reranker_key: Optional[tuple] = None
 
-    async def emit_citation(
-        self, node: NodeWithScore, __event_emitter__: Callable[[Dict[str, Any]], Any]
-    ) -> None:
-        source_name = node.metadata.get("file_name", "Retrieved Document")
-        source_name += f" ({node.id_})"
-        page_number = get_node_page(node)
-        if page_number:
-            source_name += f" - p. {page_number}"
-        await __event_emitter__(
-            {
-                "type": "citation",
-                "data": {
-                    "document": [clean_text(node.text)],
-                    "metadata": [
-                        {
-                            "source": source_name,
-                        }
-                    ],
-                    "source": {"name": source_name},
-                },
-            }
+    def get_embedding_model(self, valves: BaseModel) -> BaseEmbedding:
+        """
+        Return the cached embedding model, rebuilding it if its valves changed.
+        """
+        key = (
+            valves.embedding_model,
+            valves.embedding_query_instruction,
+            valves.ollama_base_url,
+            valves.deepinfra_api_key,
         )
+        if self._embed_model is None or self._embed_key != key:
+            self._embed_model = get_embedding_model(
+                embedding_model_name=valves.embedding_model,
+                embedding_query_instruction=valves.embedding_query_instruction,
+                ollama_base_url=valves.ollama_base_url,
+                deepinfra_api_key=valves.deepinfra_api_key,
+            )
+            self._embed_key = key
+        return self._embed_model
+
+    def get_reranker_model(self, valves: BaseModel) -> Any:
+        """
+        Return the cached reranker model (a cross-encoder or an LLM), rebuilding
+        it if its valves changed, or None if reranking uses the DeepInfra API.
+        """
+        if valves.reranker_engine == "cross-encoder":
+            key = ("cross-encoder", valves.reranker_model, valves.reranker_threads)
+            if self._reranker_model is None or self._reranker_key != key:
+                self._reranker_model = get_cross_encoder(
+                    model_name=valves.reranker_model,
+                    threads=valves.reranker_threads,
+                )
+                self._reranker_key = key
+            return self._reranker_model
+        elif valves.reranker_engine != "auto":
+            raise ValueError(f"Unknown reranker engine: {valves.reranker_engine}")
+
+        if valves.deepinfra_api_key and not valves.ollama_base_url:
+            return None
+        key = ("llm", valves.reranker_model, valves.ollama_base_url)
+        if self._reranker_model is None or self._reranker_key != key:
+            self._reranker_model = get_reranker_llm(
+                reranker_model_name=valves.reranker_model,
+                ollama_base_url=valves.ollama_base_url,
+            )
+            self._reranker_key = key
+        return self._reranker_model
 
-    async def add_if_not_exists(
+    def get_reranker(
         self,
-        node: NodeWithScore,
-        __event_emitter__: Optional[Callable[[Dict[str, Any]], Any]] = None,
-    ) -> Optional[int]:
-        # Lock required to prevent race conditions in check-and-set operation
-        # and to ensure citations are emitted in citation_id order.
-        async with self._lock:
-            if node.id_ in self._set:
-                return None
-            else:
-                if __event_emitter__:
-                    await self.emit_citation(node, __event_emitter__)
-                self._set.add(node.id_)
-                self._count += 1
-                return self._count
+        valves: BaseModel,
+        top_n: int,
+        http_pool: Optional[HTTPSessionPool] = None,
+        model: Any = None,
+    ) -> BaseNodePostprocessor:
+        """
+        Return a reranker for top_n results backed by the given reranker model,
+        or else the cached one.
+        """
+        if model is None:
+            model = self.get_reranker_model(valves)
+        if valves.reranker_engine == "cross-encoder":
+            return get_reranker_classes()["CrossEncoderReranker"](
+                top_n=top_n,
+                model=model,
+                batch_size=valves.reranker_batch_size,
+            )
+        # The postprocessor itself is a lightweight wrapper, built per query
+        # because top_n varies between requests.
+        return get_reranker(
+            top_n=top_n,
+            reranker_model_name=valves.reranker_model,
+            ollama_base_url=valves.ollama_base_url,
+            deepinfra_api_key=valves.deepinfra_api_key,
+            http_pool=http_pool,
+            llm=model,
+            max_document_tokens=valves.reranker_max_document_tokens,
+            batch_size=valves.reranker_batch_size,
+            deepinfra_base_url=valves.deepinfra_base_url,
+        )
 
 
-class Pipeline:
+class SearchTimer:
     """
-    A toolset for interacting with an existing Qdrant vector store for Retrieval-Augmented Generation
+    Per-request stage timings and counters.
+
+    A stage's duration is wall time: spans of a stage that overlap (e.g., the
+    concurrent queries of a batch) count once. Each span is also recorded as
+    an OpenTelemetry span when a tracer is given.
     """
 
-    class Valves(BaseModel):
-        qdrant_url: str = Field(
-            default="./qdrant_db",
-            description="Path to a local Qdrant directory or remote Qdrant instance.",
-        )
-        qdrant_collection_name: str = Field(
-            default="llamacollection",
-            description="Qdrant collection containing both dense vectors and sparse vectors.",
-        )
-        qdrant_api_key: Optional[str] = Field(
-            default=None,
-            description="API key for remote Qdrant instance.",
-        )
-        embedding_model: str = Field(
-            default="sentence-transformers/all-MiniLM-L6-v2",
-            description="Model for query embeddings, which should match the model used to create the text embeddings.",
-        )
-        embedding_query_instruction: Optional[str] = Field(
-            default=None,
-            description="Instruction to prepend to query before embedding, e.g., 'query:'. Escape sequences like \\n are interpreted.",
+    def __init__(self, tracer: Any = None) -> None:
+        self.durations: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self._tracer = tracer
+        # Open spans per stage, and when the stage's current run started.
+        self._active: Dict[str, int] = {}
+        self._started: Dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if self._tracer:
+            span = self._tracer.start_as_current_span(f"document_search.{name}")
+        else:
+            span = contextlib.nullcontext()
+        if not self._active.get(name):
+            self._started[name] = time.perf_counter()
+        self._active[name] = self._active.get(name, 0) + 1
+        try:
+            with span:
+                yield
+        finally:
+            self._active[name] -= 1
+            if not self._active[name]:
+                elapsed = time.perf_counter() - self._started[name]
+                self.durations[name] = self.durations.get(name, 0.0) + elapsed
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def summary(self) -> str:
+        """
+        Return the stage breakdown in milliseconds, e.g., for a status event.
+        """
+        return ", ".join(
+            f"{name} {seconds * 1000:.0f} ms"
+            for name, seconds in self.durations.items()
+        )
+
+
+class SearchMetrics:
+    """
+    Process-wide aggregates of search timings and counters.
+    """
+
+    def __init__(self) -> None:
+        self._stages: Dict[str, Dict[str, Any]] = {}
+        self._counters: Dict[str, int] = {}
+
+    def observe(self, timer: SearchTimer) -> None:
+        """
+        Add one request's timings and counters to the aggregates.
+        """
+        for name, seconds in timer.durations.items():
+            stage = self._stages.setdefault(
+                name, {"buckets": [0] * len(METRICS_BUCKETS), "sum": 0.0, "count": 0}
+            )
+            for i, bound in enumerate(METRICS_BUCKETS):
+                if seconds <= bound:
+                    stage["buckets"][i] += 1
+            stage["sum"] += seconds
+            stage["count"] += 1
+        for name, value in timer.counts.items():
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def render(
+        self, caches: Dict[str, TTLCache], gauges: Optional[Dict[str, float]] = None
+    ) -> str:
+        """
+        Return the metrics in Prometheus text exposition format.
+        """
+        lines = [
+            "# HELP document_search_stage_seconds Time spent per search stage.",
+            "# TYPE document_search_stage_seconds histogram",
+        ]
+        for name, stage in self._stages.items():
+            for bound, value in zip(METRICS_BUCKETS, stage["buckets"]):
+                lines.append(
+                    f'document_search_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {value}'
+                )
+            lines.append(
+                f'document_search_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {stage["count"]}'
+            )
+            lines.append(
+                f'document_search_stage_seconds_sum{{stage="{name}"}} {stage["sum"]}'
+            )
+            lines.append(
+                f'document_search_stage_seconds_count{{stage="{name}"}} {stage["count"]}'
+            )
+        for name, value in self._counters.items():
+            lines.append(f"# TYPE document_search_{name}_total counter")
+            lines.append(f"document_search_{name}_total {value}")
+        for metric in ("hits", "misses", "evictions"):
+            lines.append(f"# TYPE document_search_cache_{metric}_total counter")
+            for cache_name, cache in caches.items():
+                lines.append(
+                    f'document_search_cache_{metric}_total{{cache="{cache_name}"}} {getattr(cache, metric)}'
+                )
+        lines.append("# TYPE document_search_cache_entries gauge")
+        for cache_name, cache in caches.items():
+            lines.append(
+                f'document_search_cache_entries{{cache="{cache_name}"}} {len(cache)}'
+            )
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE document_search_{name} gauge")
+            lines.append(f"document_search_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    HTTP endpoint serving /metrics in Prometheus text format.
+    """
+
+    def __init__(self, render: Callable[[], str]) -> None:
+        self._render = render
+        self._runner: Optional[web.AppRunner] = None
+        self._port: Optional[int] = None
+
+    async def start(self, port: Optional[int]) -> None:
+        """
+        Serve metrics on the given port, or stop serving if port is None.
+        """
+        if port == self._port:
+            return
+        await self.stop()
+        if port is None:
+            return
+
+        async def handle_metrics(request: web.Request) -> web.Response:
+            return web.Response(text=self._render(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, port=port).start()
+        except OSError as e:
+            # Another worker may already serve the port.
+            await runner.cleanup()
+            logger.warning(f"Document search metrics server not started: {e}")
+            return
+        self._runner = runner
+        self._port = port
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+        self._runner = None
+        self._port = None
+
+
+def get_tracer() -> Any:
+    """
+    Return an OpenTelemetry tracer if opentelemetry is installed, else None.
+    """
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        return None
+    return trace.get_tracer(__name__)
+
+
+class IndexSnapshot:
+    """
+    Immutable view of the vector index, its clients and models, and the valves
+    it was built from.
+
+    Requests acquire the current snapshot without locking. When the valves
+    change, the snapshot is replaced and retired; a retired snapshot closes its
+    Qdrant client and HTTP session only after its in-flight requests drain.
+
+    peer_url is set when another worker serves the embedded store.
+    """
+
+    def __init__(
+        self,
+        version: int,
+        valves: BaseModel,
+        config: str,
+        index: VectorStoreIndex,
+        http_pool: HTTPSessionPool,
+        owns_client: bool = True,
+        embed_model: Optional[BaseEmbedding] = None,
+        reranker_model: Any = None,
+        peer_url: Optional[str] = None,
+    ) -> None:
+        self.version = version
+        self.valves = valves
+        self.config = config
+        self.config_hash = hashlib.sha256(config.encode()).hexdigest()
+        self.index = index
+        self.http_pool = http_pool
+        self.owns_client = owns_client
+        self.embed_model = (
+            embed_model if embed_model is not None else index._embed_model
+        )
+        self.reranker_model = reranker_model
+        self.peer_url = peer_url
+        self._in_flight = 0
+        self._retired = False
+        self._closed = False
+
+    def acquire(self) -> None:
+        self._in_flight += 1
+
+    async def release(self) -> None:
+        self._in_flight -= 1
+        if self._retired and self._in_flight == 0:
+            await self._close()
+
+    async def retire(self) -> None:
+        self._retired = True
+        if self._in_flight == 0:
+            await self._close()
+
+    async def _close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        await self.http_pool.close()
+        if self.owns_client:
+            await self.index.vector_store._aclient.close()
+
+
+def _file_names(file_name: Optional[Union[str, List[str]]]) -> List[str]:
+    """
+    Return the filenames to filter by, without empty strings.
+    """
+    if isinstance(file_name, str):
+        file_name = [file_name]
+    return [name for name in file_name or [] if name]
+
+
+def build_filters(
+    file_name: Optional[Union[str, List[str]]] = None,
+    file_type: Optional[str] = None,
+    modified_after: Optional[str] = None,
+    modified_before: Optional[str] = None,
+) -> Optional[models.Filter]:
+    """
+    Build a native Qdrant filter by filename(s), file type and last modified
+    date range (inclusive ISO 8601 dates), or None if no filter is given.
+    """
+    conditions = []
+    names = _file_names(file_name)
+    if len(names) == 1:
+        conditions.append(
+            models.FieldCondition(
+                key="file_name", match=models.MatchValue(value=names[0])
+            )
+        )
+    elif names:
+        conditions.append(
+            models.FieldCondition(key="file_name", match=models.MatchAny(any=names))
+        )
+    if file_type:
+        conditions.append(
+            models.FieldCondition(
+                key="file_type", match=models.MatchValue(value=file_type)
+            )
+        )
+    if modified_after or modified_before:
+        conditions.append(
+            models.FieldCondition(
+                key="last_modified_date",
+                range=models.DatetimeRange(gte=modified_after, lte=modified_before),
+            )
+        )
+    if not conditions:
+        return None
+    return models.Filter(must=conditions)
+
+
+def describe_filters(
+    file_name: Optional[Union[str, List[str]]] = None,
+    file_type: Optional[str] = None,
+    modified_after: Optional[str] = None,
+    modified_before: Optional[str] = None,
+) -> str:
+    """
+    Describe the filters for status messages, e.g., " in report.pdf".
+    """
+    description = ""
+    names = _file_names(file_name)
+    if names:
+        description += f" in {', '.join(names)}"
+    if file_type:
+        description += f" of type {file_type}"
+    if modified_after:
+        description += f" modified from {modified_after}"
+    if modified_before:
+        description += f" modified until {modified_before}"
+    return description
+
+
+async def ensure_payload_indexes(
+    aclient: AsyncQdrantClient, collection_name: str
+) -> List[str]:
+    """
+    Create the payload indexes in PAYLOAD_INDEXES that the collection is
+    missing, so filtered searches do not scan. Return the fields indexed.
+    """
+    info = await aclient.get_collection(collection_name)
+    missing = [
+        field for field in PAYLOAD_INDEXES if field not in (info.payload_schema or {})
+    ]
+    for field in missing:
+        await aclient.create_payload_index(
+            collection_name,
+            field_name=field,
+            field_schema=PAYLOAD_INDEXES[field],
+            wait=False,
+        )
+    return missing
+
+
+def get_metadata_page(metadata: Dict[str, Any]) -> Optional[int]:
+    """
+    Return page number from node metadata.
+    """
+    page = metadata.get(PAYLOAD_PAGE_KEY) or metadata.get("source")
+    if not page:
+        try:
+            page = metadata["doc_items"][0]["prov"][0]["page_no"]
+        except Exception:
+            pass
+    return page
+
+
+def get_node_page(node: NodeWithScore) -> Optional[int]:
+    """
+    Return page number of Node.
+    """
+    return get_metadata_page(node.metadata)
+
+
+CLEAN_TEXT_REMOVE_PATTERN = re.compile(
+    # HTML tags.
+    r"<[a-zA-Z/][^>]*>"
+    # Backticks.
+    # Unclosed backticks seem to cause issues with citation rendering.
+    r"|`"
+    # Citation references.
+    # Workaround for https://github.com/open-webui/open-webui/issues/17062
+    # with updated regular expression for Open WebUI 0.6.33.
+    r"|\[[\d,\s]+\]"
+)
+CLEAN_TEXT_NORMALIZE_PATTERN = re.compile(
+    # Blank lines, including lines with only whitespace.
+    r"(\n(?:[^\S\n]*\n)+)"
+    # Excessive whitespace within lines.
+    r"|( {2,})"
+    # 4 or more periods.
+    r"|(\.{4,})"
+)
+CLEAN_TEXT_REPLACEMENTS = (None, "\n\n", " ", "...")
+
+# Approximate tokens (words and punctuation) when tiktoken is not available:
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+# Sentence boundaries and query terms for trimming results to the budget:
+SENTENCE_SPLIT_PATTERN = re.compile(r"(?<=[.!?])\s+|\n+")
+QUERY_TERM_PATTERN = re.compile(r"\w{3,}")
+
+
+def _clean_text_replacement(match: re.Match) -> str:
+    return CLEAN_TEXT_REPLACEMENTS[match.lastindex]
+
+
+def clean_text(text: str) -> str:
+    """
+    Remove unwanted formatting and artifacts from text output.
+
+    Removals run first so that whitespace they leave behind is normalized by
+    the second scan.
+    """
+    text = CLEAN_TEXT_REMOVE_PATTERN.sub("", text)
+    text = CLEAN_TEXT_NORMALIZE_PATTERN.sub(_clean_text_replacement, text)
+    return text.strip()
+
+
+def get_clean_text(
+    node: NodeWithScore, cleaned_texts: Optional[Dict[str, str]] = None
+) -> str:
+    """
+    Return the cleaned node text, memoized by node ID in cleaned_texts.
+
+    Uses the text precomputed by the normalize command when it is current.
+    """
+    if node.metadata.get(PAYLOAD_SCHEMA_KEY) == PAYLOAD_SCHEMA_VERSION:
+        return node.metadata[PAYLOAD_CLEANED_TEXT_KEY]
+    if cleaned_texts is None:
+        return clean_text(node.text)
+    text = cleaned_texts.get(node.id_)
+    if text is None:
+        text = cleaned_texts[node.id_] = clean_text(node.text)
+    return text
+
+
+if msgspec is not None:
+
+    class SearchResult(msgspec.Struct):
+        """
+        Search result returned to the LLM.
+        """
+
+        id: int
+        id_: str
+        metadata: Dict[str, Any]
+        text: str
+        score: Optional[float]
+
+    class QueryResults(msgspec.Struct):
+        """
+        Search results for one query of a batch.
+        """
+
+        query: str
+        documents: List[SearchResult]
+
+    _msgspec_encoder = msgspec.json.Encoder()
+
+else:
+
+    @dataclass(slots=True)
+    class SearchResult:
+        """
+        Search result returned to the LLM.
+        """
+
+        id: int
+        id_: str
+        metadata: Dict[str, Any]
+        text: str
+        score: Optional[float]
+
+    @dataclass(slots=True)
+    class QueryResults:
+        """
+        Search results for one query of a batch.
+        """
+
+        query: str
+        documents: List[SearchResult]
+
+
+def _slots_to_dict(obj: Any) -> Dict[str, Any]:
+    """
+    Convert a result object for the json module, which does not know them.
+    """
+    try:
+        return {name: getattr(obj, name) for name in obj.__slots__}
+    except AttributeError:
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def serialize_results(results: Union[List[SearchResult], List[QueryResults]]) -> str:
+    """
+    Serialize search results to compact JSON with the fastest available encoder.
+    """
+    if msgspec is not None:
+        return _msgspec_encoder.encode(results).decode()
+    if orjson is not None:
+        return orjson.dumps(results).decode()
+    return json.dumps(results, default=_slots_to_dict, separators=(",", ":"))
+
+
+def clean_node(
+    node: NodeWithScore,
+    citation_id: int,
+    cleaned_texts: Optional[Dict[str, str]] = None,
+    text: Optional[str] = None,
+) -> SearchResult:
+    """
+    Remove internal LlamaIndex node attributes.
+
+    The cleaned node text is returned unless text (e.g., a trimmed window) is given.
+    """
+    metadata = {k: v for k, v in node.metadata.items() if k in RESULT_METADATA_FIELDS}
+    page = get_node_page(node)
+    if page:
+        metadata["page"] = page
+    return SearchResult(
+        id=citation_id,
+        id_=node.id_,
+        metadata=metadata,
+        text=get_clean_text(node, cleaned_texts) if text is None else text,
+        score=node.score,
+    )
+
+
+_token_counter: Optional[Callable[[str], int]] = None
+
+
+def get_token_counter() -> Callable[[str], int]:
+    """
+    Return a function counting tokens with tiktoken if it is installed, else
+    approximately as words and punctuation marks.
+    """
+    global _token_counter
+    if _token_counter is not None:
+        return _token_counter
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        # Not installed, or the encoding could not be downloaded.
+        logger.debug(f"Counting approximate tokens: {e}")
+
+        def count_tokens(text: str) -> int:
+            return len(TOKEN_PATTERN.findall(text))
+
+    else:
+
+        def count_tokens(text: str) -> int:
+            return len(encoding.encode_ordinary(text))
+
+    _token_counter = count_tokens
+    return _token_counter
+
+
+def trim_text(
+    text: str,
+    query_terms: set,
+    max_tokens: int,
+    count_tokens: Callable[[str], int],
+) -> str:
+    """
+    Return the run of consecutive sentences in text that fits in max_tokens
+    around the sentence with the most query terms, with ellipses marking cuts.
+    """
+    sentences = [s for s in SENTENCE_SPLIT_PATTERN.split(text) if s.strip()]
+    if not sentences:
+        return ""
+    costs = [count_tokens(sentence) for sentence in sentences]
+    start = max(
+        range(len(sentences)),
+        key=lambda i: len(
+            query_terms.intersection(QUERY_TERM_PATTERN.findall(sentences[i].lower()))
+        ),
+    )
+    end = start + 1
+    used = costs[start]
+    if used > max_tokens:
+        # Cut an overlong sentence in proportion to the budget.
+        window = sentences[start][: len(sentences[start]) * max_tokens // used]
+        cut_end = True
+    else:
+        # Grow the window alternately with following and preceding sentences.
+        grown = True
+        while grown:
+            grown = False
+            if end < len(sentences) and used + costs[end] <= max_tokens:
+                used += costs[end]
+                end += 1
+                grown = True
+            if start > 0 and used + costs[start - 1] <= max_tokens:
+                start -= 1
+                used += costs[start]
+                grown = True
+        window = " ".join(sentences[start:end])
+        cut_end = end < len(sentences)
+    return ("... " if start else "") + window + (" ..." if cut_end else "")
+
+
+def pack_results(
+    nodes: List[NodeWithScore],
+    query: str,
+    max_tokens: int,
+    cleaned_texts: Optional[Dict[str, str]] = None,
+    texts: Optional[Dict[str, str]] = None,
+) -> Tuple[List[NodeWithScore], Dict[str, str]]:
+    """
+    Select the ranked nodes whose results fit in a token budget.
+
+    Texts by node ID (e.g., with context added) replace the cleaned node texts.
+
+    Results are kept whole while they fit. Otherwise the text is trimmed to
+    the sentences most relevant to the query, or the node is dropped if less
+    than RESULT_MIN_TOKENS of text would fit. Returns the kept nodes in rank
+    order and the trimmed texts by node ID.
+    """
+    count_tokens = get_token_counter()
+    query_terms = set(QUERY_TERM_PATTERN.findall(query.lower()))
+    packed = []
+    trimmed_texts: Dict[str, str] = {}
+    remaining = max_tokens
+    for node in nodes:
+        # Tokens of the serialized result besides its text.
+        overhead = count_tokens(
+            serialize_results([clean_node(node, RESULTS_MAX, text="")])
+        )
+        text = (texts or {}).get(node.id_) or get_clean_text(node, cleaned_texts)
+        cost = overhead + count_tokens(text)
+        if cost <= remaining:
+            packed.append(node)
+            remaining -= cost
+            continue
+        available = remaining - overhead - RESULT_ELLIPSIS_TOKENS
+        if available >= RESULT_MIN_TOKENS:
+            trimmed = trim_text(text, query_terms, available, count_tokens)
+            packed.append(node)
+            trimmed_texts[node.id_] = trimmed
+            remaining -= overhead + count_tokens(trimmed)
+    return packed, trimmed_texts
+
+
+def normalize_node_content(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Return the LlamaIndex node content of a payload with cleaned text, page
+    and schema version added to its metadata, or None if there is none.
+    """
+    try:
+        node_content = json.loads(payload["_node_content"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    metadata = node_content.setdefault("metadata", {})
+    relationships = node_content.get("relationships") or {}
+    neighbor_ids = {}
+    for key, relationship in (
+        (PAYLOAD_PREVIOUS_KEY, NODE_RELATIONSHIP_PREVIOUS),
+        (PAYLOAD_NEXT_KEY, NODE_RELATIONSHIP_NEXT),
+    ):
+        related = relationships.get(relationship)
+        neighbor_ids[key] = (
+            related.get("node_id") if isinstance(related, dict) else None
+        )
+    fields = {
+        PAYLOAD_CLEANED_TEXT_KEY: clean_text(
+            node_content.get("text") or payload.get("text") or ""
+        ),
+        PAYLOAD_PAGE_KEY: get_metadata_page(metadata),
+        **neighbor_ids,
+        PAYLOAD_SCHEMA_KEY: PAYLOAD_SCHEMA_VERSION,
+    }
+    metadata.update(fields)
+    for excluded_key in ("excluded_llm_metadata_keys", "excluded_embed_metadata_keys"):
+        excluded = node_content.setdefault(excluded_key, [])
+        excluded.extend(k for k in fields if k not in excluded)
+    return node_content
+
+
+def normalize_payload(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Return the payload fields to set so that query time skips text cleaning,
+    or None if the payload has no LlamaIndex node content.
+
+    The fields are added to the node metadata in _node_content (excluded from
+    the LLM and embedding metadata) and to the top-level payload.
+    """
+    node_content = normalize_node_content(payload)
+    if node_content is None:
+        return None
+    fields = {
+        key: node_content["metadata"][key]
+        for key in (
+            PAYLOAD_CLEANED_TEXT_KEY,
+            PAYLOAD_PAGE_KEY,
+            PAYLOAD_PREVIOUS_KEY,
+            PAYLOAD_NEXT_KEY,
+            PAYLOAD_SCHEMA_KEY,
+        )
+    }
+    return {**fields, "_node_content": json.dumps(node_content)}
+
+
+def build_projected_node(point_id: Any, payload: Dict[str, Any]) -> TextNode:
+    """
+    Build a lightweight node holding only the fields clean_node returns.
+
+    The payload must carry the fields precomputed by the normalize command.
+    """
+    from llama_index.core.schema import TextNode
+
+    metadata = {key: payload[key] for key in PROJECTED_PAYLOAD_FIELDS if key in payload}
+    internal_keys = [
+        PAYLOAD_CLEANED_TEXT_KEY,
+        PAYLOAD_SCHEMA_KEY,
+        PAYLOAD_PREVIOUS_KEY,
+        PAYLOAD_NEXT_KEY,
+    ]
+    return TextNode(
+        id_=str(point_id),
+        text=payload.get(PAYLOAD_CLEANED_TEXT_KEY) or "",
+        metadata=metadata,
+        excluded_llm_metadata_keys=internal_keys,
+        excluded_embed_metadata_keys=internal_keys,
+    )
+
+
+def get_sparse_query_vector(
+    vector_store: QdrantVectorStore, query: str
+) -> models.SparseVector:
+    """
+    Encode a query with the vector store's sparse (BM25) query encoder.
+    """
+    [indices], [values] = vector_store._sparse_query_fn([query])
+    return models.SparseVector(indices=indices, values=values)
+
+
+async def load_projected_nodes(
+    vector_store: QdrantVectorStore,
+    points: List[Union[models.ScoredPoint, models.Record]],
+) -> Dict[Any, TextNode]:
+    """
+    Build lightweight nodes by point ID from points with a projected payload.
+
+    Points not yet normalized are fetched again in one batch with their node
+    content and cleaned here.
+    """
+    payloads = {}
+    for point in points:
+        payloads[point.id] = point.payload or {}
+    outdated = [
+        point_id
+        for point_id, payload in payloads.items()
+        if payload.get(PAYLOAD_SCHEMA_KEY) != PAYLOAD_SCHEMA_VERSION
+    ]
+    if outdated:
+        for record in await vector_store._aclient.retrieve(
+            vector_store.collection_name, ids=outdated, with_payload=["_node_content"]
+        ):
+            node_content = normalize_node_content(record.payload or {})
+            if node_content is not None:
+                payloads[record.id] = node_content["metadata"]
+    return {
+        point_id: build_projected_node(point_id, payload)
+        for point_id, payload in payloads.items()
+    }
+
+
+async def retrieve_projected(
+    vector_store: QdrantVectorStore,
+    query: str,
+    embedding: List[float],
+    top_k: int,
+    filters: Optional[models.Filter] = None,
+    search_params: Optional[models.SearchParams] = None,
+) -> List[NodeWithScore]:
+    """
+    Run hybrid retrieval directly against Qdrant with a projected payload.
+
+    The dense and sparse searches run in a single batch request and return
+    only the fields clean_node keeps, instead of whole LlamaIndex nodes. They
+    are fused with LlamaIndex's relative score fusion so scores match the
+    default engine.
+    """
+    from llama_index.core.schema import NodeWithScore
+    from llama_index.core.vector_stores.types import VectorStoreQueryResult
+    from llama_index.vector_stores.qdrant.utils import relative_score_fusion
+
+    dense_response, sparse_response = await vector_store._aclient.query_batch_points(
+        vector_store.collection_name,
+        requests=[
+            models.QueryRequest(
+                query=embedding,
+                using=vector_store.dense_vector_name,
+                limit=top_k,
+                filter=filters,
+                params=search_params,
+                with_payload=PROJECTED_PAYLOAD_FIELDS,
+            ),
+            models.QueryRequest(
+                query=get_sparse_query_vector(vector_store, query),
+                using=vector_store.sparse_vector_name,
+                limit=top_k,
+                filter=filters,
+                with_payload=PROJECTED_PAYLOAD_FIELDS,
+            ),
+        ],
+    )
+    nodes = await load_projected_nodes(
+        vector_store, dense_response.points + sparse_response.points
+    )
+
+    def to_result(points: List[models.ScoredPoint]) -> VectorStoreQueryResult:
+        return VectorStoreQueryResult(
+            nodes=[nodes[point.id] for point in points],
+            similarities=[point.score for point in points],
+            ids=[str(point.id) for point in points],
+        )
+
+    fused = relative_score_fusion(
+        to_result(dense_response.points),
+        to_result(sparse_response.points),
+        alpha=HYBRID_ALPHA,
+        top_k=top_k,
+    )
+    return [
+        NodeWithScore(node=node, score=score)
+        for node, score in zip(fused.nodes or [], fused.similarities or [])
+    ]
+
+
+async def retrieve_native(
+    vector_store: QdrantVectorStore,
+    query: str,
+    embedding: List[float],
+    top_k: int,
+    filters: Optional[models.Filter] = None,
+    fusion: str = "rrf",
+    search_params: Optional[models.SearchParams] = None,
+) -> List[NodeWithScore]:
+    """
+    Run hybrid retrieval with Qdrant's Query API and server-side fusion.
+
+    Dense and sparse candidates are prefetched and fused by Qdrant (RRF or
+    DBSF) in a single request, returning the projected payload. Fused scores
+    are on a different scale than the LlamaIndex engine's.
+    """
+    from llama_index.core.schema import NodeWithScore
+
+    response = await vector_store._aclient.query_points(
+        vector_store.collection_name,
+        prefetch=[
+            models.Prefetch(
+                query=embedding,
+                using=vector_store.dense_vector_name,
+                limit=top_k,
+                filter=filters,
+                params=search_params,
+            ),
+            models.Prefetch(
+                query=get_sparse_query_vector(vector_store, query),
+                using=vector_store.sparse_vector_name,
+                limit=top_k,
+                filter=filters,
+            ),
+        ],
+        query=models.FusionQuery(fusion=models.Fusion(fusion)),
+        limit=top_k,
+        query_filter=filters,
+        with_payload=PROJECTED_PAYLOAD_FIELDS,
+    )
+    nodes = await load_projected_nodes(vector_store, response.points)
+    return [
+        NodeWithScore(node=nodes[point.id], score=point.score)
+        for point in response.points
+    ]
+
+
+def get_neighbor_ids(node: NodeWithScore) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Return the IDs of the previous and next chunks of a node, from its
+    LlamaIndex relationships or the fields precomputed by the normalize command.
+    """
+    previous_node = node.node.prev_node
+    next_node = node.node.next_node
+    return (
+        (
+            previous_node.node_id
+            if previous_node
+            else node.metadata.get(PAYLOAD_PREVIOUS_KEY)
+        ),
+        next_node.node_id if next_node else node.metadata.get(PAYLOAD_NEXT_KEY),
+    )
+
+
+async def expand_context(
+    vector_store: QdrantVectorStore,
+    nodes: List[NodeWithScore],
+    exclude: Optional[set] = None,
+    cleaned_texts: Optional[Dict[str, str]] = None,
+) -> Dict[str, str]:
+    """
+    Return the texts of ranked nodes joined with their previous and next
+    chunks, by node ID, for the nodes that gained any.
+
+    The neighbors of all nodes are fetched in one batch. Each chunk is added
+    at most once, next to the highest-ranked node, and not at all if it is one
+    of the nodes or in exclude (e.g., already cited), so that overlapping
+    windows do not repeat text.
+    """
+    used = {node.id_ for node in nodes}
+    used.update(exclude or ())
+    windows = []
+    for node in nodes:
+        window = []
+        for neighbor_id in get_neighbor_ids(node):
+            if neighbor_id and neighbor_id not in used:
+                used.add(neighbor_id)
+                window.append(neighbor_id)
+            else:
+                window.append(None)
+        windows.append(window)
+    neighbor_ids = [
+        neighbor_id for window in windows for neighbor_id in window if neighbor_id
+    ]
+    if not neighbor_ids:
+        return {}
+
+    records = await vector_store._aclient.retrieve(
+        vector_store.collection_name,
+        ids=neighbor_ids,
+        with_payload=PROJECTED_PAYLOAD_FIELDS,
+    )
+    neighbor_texts = {
+        str(point_id): get_clean_text(neighbor)
+        for point_id, neighbor in (
+            await load_projected_nodes(vector_store, records)
+        ).items()
+    }
+
+    texts = {}
+    for node, (previous_id, next_id) in zip(nodes, windows):
+        previous_text = neighbor_texts.get(previous_id)
+        next_text = neighbor_texts.get(next_id)
+        if previous_text or next_text:
+            parts = (previous_text, get_clean_text(node, cleaned_texts), next_text)
+            texts[node.id_] = "\n\n".join(part for part in parts if part)
+    return texts
+
+
+def build_search_params(
+    hnsw_ef: Optional[int] = None,
+    exact: bool = False,
+    quantization_rescore: Optional[bool] = None,
+    quantization_oversampling: Optional[float] = None,
+) -> Optional[models.SearchParams]:
+    """
+    Build Qdrant search parameters for dense vector search, or None to use
+    the collection defaults.
+    """
+    quantization = None
+    if quantization_rescore is not None or quantization_oversampling is not None:
+        quantization = models.QuantizationSearchParams(
+            rescore=quantization_rescore, oversampling=quantization_oversampling
+        )
+    if hnsw_ef is None and not exact and quantization is None:
+        return None
+    return models.SearchParams(hnsw_ef=hnsw_ef, exact=exact, quantization=quantization)
+
+
+async def quantize_collection(
+    aclient: AsyncQdrantClient,
+    collection_name: str,
+    method: str,
+    on_disk: Optional[bool] = None,
+    dense_vector_name: str = "text-dense",
+) -> None:
+    """
+    Enable scalar (int8) or binary quantization on an existing collection, or
+    disable it with method "none". Quantized vectors are kept in RAM; with
+    on_disk, the original dense vectors move to disk and are only read for
+    rescoring.
+    """
+    if method == "scalar":
+        quantization_config = models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8, quantile=0.99, always_ram=True
+            )
+        )
+    elif method == "binary":
+        quantization_config = models.BinaryQuantization(
+            binary=models.BinaryQuantizationConfig(always_ram=True)
+        )
+    elif method == "none":
+        quantization_config = models.Disabled.DISABLED
+    else:
+        raise ValueError(f"Unknown quantization method: {method}")
+    vectors_config = None
+    if on_disk is not None:
+        vectors_config = {dense_vector_name: models.VectorParamsDiff(on_disk=on_disk)}
+    await aclient.update_collection(
+        collection_name,
+        quantization_config=quantization_config,
+        vectors_config=vectors_config,
+    )
+
+
+async def normalize_collection(
+    aclient: AsyncQdrantClient, collection_name: str, batch_size: int = 256
+) -> int:
+    """
+    Precompute cleaned text and page number in every point payload that does
+    not have the current schema version. Return the number of points updated.
+
+    Safe to rerun or interrupt; updated points are skipped on the next run.
+    """
+    outdated = models.Filter(
+        must_not=[
+            models.FieldCondition(
+                key=PAYLOAD_SCHEMA_KEY,
+                match=models.MatchValue(value=PAYLOAD_SCHEMA_VERSION),
+            )
+        ]
+    )
+    updated = 0
+    offset = None
+    while True:
+        points, offset = await aclient.scroll(
+            collection_name,
+            scroll_filter=outdated,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+        )
+        operations = []
+        for point in points:
+            fields = normalize_payload(point.payload or {})
+            if fields is None:
+                continue
+            operations.append(
+                models.SetPayloadOperation(
+                    set_payload=models.SetPayload(payload=fields, points=[point.id])
+                )
+            )
+        if operations:
+            await aclient.batch_update_points(collection_name, operations)
+            updated += len(operations)
+            logger.info(f"Normalized {updated} points in {collection_name}")
+        if offset is None:
+            return updated
+
+
+def get_async_qdrant_client(
+    qdrant_url: str, qdrant_api_key: Optional[str] = None
+) -> AsyncQdrantClient:
+    """
+    Return an async client for a local Qdrant directory or remote instance.
+    """
+    parsed_url = urlparse(qdrant_url, scheme="file")
+    if parsed_url.scheme == "file":
+        return AsyncQdrantClient(path=parsed_url.path)
+    return AsyncQdrantClient(url=qdrant_url, api_key=qdrant_api_key or None)
+
+
+def is_connection_error(error: BaseException) -> bool:
+    """
+    Return whether error (or the error it wraps) is a failure to connect.
+    """
+    while error is not None:
+        if isinstance(error, (ConnectionError, httpx.ConnectError)):
+            return True
+        if isinstance(error, ResponseHandlingException):
+            error = error.source
+        else:
+            error = error.__cause__ or error.__context__
+    return False
+
+
+def is_loopback_host(host: str) -> bool:
+    """
+    Return whether host is localhost or an IPv4 loopback address.
+    """
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.IPv4Address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class EmbeddedQdrantServer:
+    """
+    Serve an embedded Qdrant store over the subset of the Qdrant REST API
+    used by this pipeline and its maintenance commands, so that other
+    processes can use it with AsyncQdrantClient(url=...).
+
+    The API includes writes and has no authentication, so the server only
+    binds to loopback.
+    """
+
+    def __init__(self, aclient: AsyncQdrantClient) -> None:
+        self._aclient = aclient
+        self._runner: Optional[web.AppRunner] = None
+
+    @staticmethod
+    def bind(port: int, host: str = "127.0.0.1") -> Optional[socket.socket]:
+        """
+        Return a listening socket on the port, or None if another process
+        already serves it.
+        """
+        if not is_loopback_host(host):
+            raise ValueError(f"Refusing to serve on non-loopback host {host}")
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Allows rebinding after a restart; Linux still refuses a second
+        # listener on the port.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((host, port))
+            sock.listen(128)
+        except OSError:
+            sock.close()
+            return None
+        return sock
+
+    async def start(self, sock: socket.socket) -> None:
+        app = web.Application(client_max_size=64 * 1024**2)
+        app.router.add_get("/", self._handle_root)
+        app.router.add_get("/collections/{name}", self._handle_get_collection)
+        app.router.add_get("/collections/{name}/exists", self._handle_exists)
+        app.router.add_put("/collections/{name}/index", self._handle_create_index)
+        app.router.add_post("/collections/{name}/points", self._handle_retrieve)
+        app.router.add_post("/collections/{name}/points/scroll", self._handle_scroll)
+        app.router.add_post("/collections/{name}/points/query", self._handle_query)
+        app.router.add_post(
+            "/collections/{name}/points/query/batch", self._handle_query_batch
+        )
+        app.router.add_post(
+            "/collections/{name}/points/payload", self._handle_set_payload
+        )
+        app.router.add_post("/collections/{name}/points/batch", self._handle_batch)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.SockSite(self._runner, sock).start()
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+        self._runner = None
+
+    @staticmethod
+    def _to_json(result: Any) -> Any:
+        if isinstance(result, BaseModel):
+            return result.model_dump(mode="json")
+        if isinstance(result, (list, tuple)):
+            return [EmbeddedQdrantServer._to_json(item) for item in result]
+        return result
+
+    async def _respond(self, call: Any) -> web.Response:
+        start = time.perf_counter()
+        try:
+            result = await call
+        except ValueError as e:
+            # Raised by the embedded store, e.g., for a missing collection.
+            return web.json_response({"status": {"error": str(e)}}, status=404)
+        except Exception as e:
+            logger.exception("Embedded Qdrant request failed")
+            return web.json_response({"status": {"error": str(e)}}, status=500)
+        return web.json_response(
+            {
+                "result": self._to_json(result),
+                "status": "ok",
+                "time": time.perf_counter() - start,
+            }
+        )
+
+    async def _handle_root(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "title": "qdrant - vector search engine",
+                "version": package_version("qdrant-client"),
+            }
+        )
+
+    async def _handle_get_collection(self, request: web.Request) -> web.Response:
+        return await self._respond(
+            self._aclient.get_collection(request.match_info["name"])
+        )
+
+    async def _handle_exists(self, request: web.Request) -> web.Response:
+        async def exists() -> models.CollectionExistence:
+            return models.CollectionExistence(
+                exists=await self._aclient.collection_exists(request.match_info["name"])
+            )
+
+        return await self._respond(exists())
+
+    async def _handle_create_index(self, request: web.Request) -> web.Response:
+        body = models.CreateFieldIndex(**await request.json())
+        return await self._respond(
+            self._aclient.create_payload_index(
+                request.match_info["name"],
+                field_name=body.field_name,
+                field_schema=body.field_schema,
+            )
+        )
+
+    async def _handle_retrieve(self, request: web.Request) -> web.Response:
+        body = models.PointRequest(**await request.json())
+        return await self._respond(
+            self._aclient.retrieve(
+                request.match_info["name"],
+                ids=body.ids,
+                with_payload=body.with_payload,
+                with_vectors=body.with_vector,
+            )
+        )
+
+    async def _handle_scroll(self, request: web.Request) -> web.Response:
+        body = models.ScrollRequest(**await request.json())
+
+        async def scroll() -> models.ScrollResult:
+            points, next_page_offset = await self._aclient.scroll(
+                request.match_info["name"],
+                scroll_filter=body.filter,
+                limit=body.limit or 10,
+                order_by=body.order_by,
+                offset=body.offset,
+                with_payload=body.with_payload,
+                with_vectors=body.with_vector,
+            )
+            return models.ScrollResult(points=points, next_page_offset=next_page_offset)
+
+        return await self._respond(scroll())
+
+    async def _handle_query(self, request: web.Request) -> web.Response:
+        body = models.QueryRequest(**await request.json())
+
+        async def query() -> models.QueryResponse:
+            [response] = await self._aclient.query_batch_points(
+                request.match_info["name"], requests=[body]
+            )
+            return response
+
+        return await self._respond(query())
+
+    async def _handle_query_batch(self, request: web.Request) -> web.Response:
+        body = models.QueryRequestBatch(**await request.json())
+        return await self._respond(
+            self._aclient.query_batch_points(
+                request.match_info["name"], requests=body.searches
+            )
+        )
+
+    async def _handle_set_payload(self, request: web.Request) -> web.Response:
+        body = models.SetPayload(**await request.json())
+        return await self._respond(
+            self._aclient.set_payload(
+                request.match_info["name"],
+                payload=body.payload,
+                points=body.points if body.points is not None else body.filter,
+                key=body.key,
+            )
+        )
+
+    async def _handle_batch(self, request: web.Request) -> web.Response:
+        body = models.UpdateOperations(**await request.json())
+        return await self._respond(
+            self._aclient.batch_update_points(
+                request.match_info["name"], update_operations=body.operations
+            )
+        )
+
+
+class EmbeddedQdrant:
+    """
+    Process-wide owner of embedded (file://) Qdrant stores.
+
+    An embedded store locks its directory, so it is opened once per path and
+    shared by all index snapshots until close(). With a port, the store is
+    also shared across worker processes: the worker that binds the port opens
+    the store and serves it on localhost, and the others connect over HTTP.
+    Each connect() retries the election, so another worker takes over after
+    the owner exits; the pipeline reconnects when a search cannot reach it.
+    """
+
+    def __init__(self) -> None:
+        self._clients: Dict[str, AsyncQdrantClient] = {}
+        self._servers: Dict[int, EmbeddedQdrantServer] = {}
+
+    async def connect(
+        self, path: str, port: Optional[int] = None
+    ) -> Tuple[Optional[AsyncQdrantClient], Optional[str]]:
+        """
+        Return (client, None) if this process owns the store at path, or
+        (None, url) of the worker that serves it.
+        """
+        if path in self._clients:
+            return self._clients[path], None
+        if port is None:
+            self._clients[path] = AsyncQdrantClient(path=path)
+            return self._clients[path], None
+        sock = EmbeddedQdrantServer.bind(port)
+        if sock is None:
+            return None, f"http://127.0.0.1:{port}"
+        try:
+            aclient = AsyncQdrantClient(path=path)
+            server = EmbeddedQdrantServer(aclient)
+            await server.start(sock)
+        except Exception:
+            sock.close()
+            raise
+        logger.info(f"Serving embedded Qdrant store {path} on port {port}")
+        self._clients[path] = aclient
+        self._servers[port] = server
+        return aclient, None
+
+    async def close(self) -> None:
+        for server in self._servers.values():
+            await server.stop()
+        for aclient in self._clients.values():
+            await aclient.close()
+        self._servers.clear()
+        self._clients.clear()
+
+
+class CitationIndex:
+    def __init__(
+        self, backend: Optional[StateBackend] = None, conversation: str = ""
+    ) -> None:
+        self._backend = backend or MemoryStateBackend(maxsize=1)
+        self._conversation = conversation
+        self._lock = asyncio.Lock()
+        # Last scheduled emission; each emission waits for the previous one.
+        self._emission: Optional[asyncio.Task] = None
+
+    async def get_cited(self, node_ids: List[str]) -> set:
+        """
+        Return the node IDs among node_ids that were already cited.
+        """
+        cited = await self._backend.is_cited(self._conversation, node_ids)
+        return {node_id for node_id, is_cited in zip(node_ids, cited) if is_cited}
+
+    async def emit_citation(
+        self,
+        node: NodeWithScore,
+        __event_emitter__: Callable[[Dict[str, Any]], Any],
+        cleaned_texts: Optional[Dict[str, str]] = None,
+    ) -> None:
+        source_name = node.metadata.get("file_name", "Retrieved Document")
+        source_name += f" ({node.id_})"
+        page_number = get_node_page(node)
+        if page_number:
+            source_name += f" - p. {page_number}"
+        await __event_emitter__(
+            {
+                "type": "citation",
+                "data": {
+                    "document": [get_clean_text(node, cleaned_texts)],
+                    "metadata": [
+                        {
+                            "source": source_name,
+                        }
+                    ],
+                    "source": {"name": source_name},
+                },
+            }
+        )
+
+    async def _emit_citations(
+        self,
+        previous: Optional[asyncio.Task],
+        nodes: List[NodeWithScore],
+        __event_emitter__: Callable[[Dict[str, Any]], Any],
+        cleaned_texts: Optional[Dict[str, str]] = None,
+    ) -> None:
+        if previous:
+            # Wait without raising; the previous request reports its own errors.
+            await asyncio.wait([previous])
+        for node in nodes:
+            await self.emit_citation(node, __event_emitter__, cleaned_texts)
+
+    async def add_all_if_not_exists(
+        self,
+        nodes: List[NodeWithScore],
+        __event_emitter__: Optional[Callable[[Dict[str, Any]], Any]] = None,
+        cleaned_texts: Optional[Dict[str, str]] = None,
+    ) -> Tuple[List[Optional[int]], Optional[asyncio.Task]]:
+        """
+        Assign citation IDs to nodes not cited before (None for the others)
+        and schedule their citation events.
+
+        Returns the IDs and the emission task, which the caller should await
+        before returning its results. Events go out after those of earlier
+        calls, so the frontend sees them in citation_id order, but the lock is
+        only held while assigning IDs.
+        """
+        # Lock required so that emissions are chained in the order IDs were
+        # assigned. The IDs are claimed atomically in one backend call.
+        async with self._lock:
+            citation_ids = await self._backend.claim_citations(
+                self._conversation, [node.id_ for node in nodes]
+            )
+            cited_nodes = [
+                node
+                for node, citation_id in zip(nodes, citation_ids)
+                if citation_id is not None
+            ]
+            if not __event_emitter__ or not cited_nodes:
+                return citation_ids, None
+            self._emission = asyncio.create_task(
+                self._emit_citations(
+                    self._emission, cited_nodes, __event_emitter__, cleaned_texts
+                )
+            )
+            return citation_ids, self._emission
+
+
+class Pipeline:
+    """
+    A toolset for interacting with an existing Qdrant vector store for Retrieval-Augmented Generation
+    """
+
+    class Valves(BaseModel):
+        qdrant_url: str = Field(
+            default="./qdrant_db",
+            description="Path to a local Qdrant directory or remote Qdrant instance.",
+        )
+        qdrant_collection_name: str = Field(
+            default="llamacollection",
+            description="Qdrant collection containing both dense vectors and sparse vectors.",
+        )
+        qdrant_api_key: Optional[str] = Field(
+            default=None,
+            description="API key for remote Qdrant instance.",
+        )
+        state_backend_url: Optional[str] = Field(
+            default=None,
+            description="Redis URL, e.g., 'redis://redis:6379/0', to share citation numbering and the query cache across workers. Requires the redis package. Leave empty to keep state in memory.",
+        )
+        share_query_cache: bool = Field(
+            default=True,
+            description="With a state backend URL, also cache query embeddings in the shared backend.",
+        )
+        embedded_qdrant_port: Optional[int] = Field(
+            default=None,
+            description="For a local Qdrant directory with multiple workers: the first worker serves the directory on this localhost port and the others connect to it. Leave empty for a single worker.",
+        )
+        embedding_model: str = Field(
+            default="sentence-transformers/all-MiniLM-L6-v2",
+            description="Model for query embeddings, which should match the model used to create the text embeddings.",
+        )
+        embedding_query_instruction: Optional[str] = Field(
+            default=None,
+            description="Instruction to prepend to query before embedding, e.g., 'query:'. Escape sequences like \\n are interpreted.",
         )
         reranker_model: Optional[str] = Field(
             default=None,
             description="Model for reranking search results. When set, retrieves more candidates to improve quality.",
         )
+        create_payload_indexes: bool = Field(
+            default=True,
+            description="Create missing Qdrant payload indexes for the filterable fields (file_name, file_type, last_modified_date) when connecting to the collection.",
+        )
+        retrieval_engine: str = Field(
+            default="llamaindex",
+            description="Retrieval engine: 'llamaindex' loads whole LlamaIndex nodes; 'projected' queries Qdrant directly and fetches only the payload fields returned to the LLM (run the normalize command first for best results); 'qdrant' also fuses dense and sparse results server-side in a single Query API request.",
+        )
+        hybrid_fusion: str = Field(
+            default="rrf",
+            description="Server-side fusion of dense and sparse results for the 'qdrant' retrieval engine: 'rrf' (reciprocal rank fusion) or 'dbsf' (distribution-based score fusion).",
+        )
+        search_hnsw_ef: Optional[int] = Field(
+            default=None,
+            description="HNSW ef for dense search (higher is more accurate but slower). Leave empty for the collection default.",
+        )
+        search_exact: bool = Field(
+            default=False,
+            description="Use exact (brute-force) dense search instead of HNSW.",
+        )
+        quantization_rescore: Optional[bool] = Field(
+            default=None,
+            description="On quantized collections, rescore candidates with the original vectors. Leave empty for the Qdrant default.",
+        )
+        quantization_oversampling: Optional[float] = Field(
+            default=None,
+            description="On quantized collections, fetch this many times more candidates before rescoring, e.g., 2.0.",
+        )
+        reranker_engine: str = Field(
+            default="auto",
+            description="Reranker engine: 'auto' uses Ollama, DeepInfra or a HuggingFace LLM depending on the other valves; 'cross-encoder' scores locally with a fastembed cross-encoder model, e.g., 'Xenova/ms-marco-MiniLM-L-6-v2'.",
+        )
+        reranker_threads: Optional[int] = Field(
+            default=None,
+            description="Number of CPU threads for the local cross-encoder reranker. Leave empty to use all cores.",
+        )
+        reranker_adaptive: bool = Field(
+            default=False,
+            description="Rerank candidates in waves ordered by hybrid score and stop once the top results are stable, instead of reranking all candidates.",
+        )
+        reranker_wave_size: int = Field(
+            default=20,
+            description="Number of candidates reranked per wave in adaptive mode.",
+        )
+        reranker_min_hybrid_score: Optional[float] = Field(
+            default=None,
+            description="In adaptive mode, stop reranking after the first wave once candidates' hybrid search scores fall below this threshold. Score scales differ between retrieval engines.",
+        )
+        reranker_max_document_tokens: Optional[int] = Field(
+            default=1024,
+            description="Approximate token budget each document is truncated to before remote reranking. Leave empty to send full texts.",
+        )
+        reranker_batch_size: int = Field(
+            default=25,
+            description="Maximum number of documents per remote reranker request or local cross-encoder inference batch. Larger candidate sets are split into concurrent requests.",
+        )
         ollama_base_url: Optional[str] = Field(
             default=None,
             description="Base URL for Ollama API. When set, uses Ollama instead of downloading the embedding/reranker models from HuggingFace.",
@@ -423,6 +2575,54 @@ class Pipeline:
             default=None,
             description="API key for DeepInfra. When set, uses DeepInfra instead of downloading the embedding/reranker models from HuggingFace.",
         )
+        deepinfra_base_url: Optional[str] = Field(
+            default=None,
+            description="Base URL of the DeepInfra inference API used for reranking, e.g., for a proxy. Leave empty for the default.",
+        )
+        http_pool_limit: int = Field(
+            default=100,
+            description="Maximum number of pooled HTTP connections for remote reranker requests.",
+        )
+        http_keepalive_timeout: float = Field(
+            default=30.0,
+            description="Seconds to keep idle pooled HTTP connections open for reuse.",
+        )
+        http_request_timeout: float = Field(
+            default=60.0,
+            description="Timeout in seconds for each remote reranker request.",
+        )
+        query_cache_size: int = Field(
+            default=1024,
+            description="Maximum number of cached dense and sparse query vectors. Set to 0 to disable.",
+        )
+        query_cache_ttl: float = Field(
+            default=3600.0,
+            description="Seconds to keep cached query vectors.",
+        )
+        expand_context: bool = Field(
+            default=False,
+            description="Add the previous and next chunks of each result to its text, fetched in one batch, unless they are results themselves or were already cited in the chat.",
+        )
+        max_result_tokens: Optional[int] = Field(
+            default=None,
+            description="Approximate token budget for the results of a search (split evenly between the queries of a batch search). Counted with tiktoken if installed. Lower-ranked results that do not fit are trimmed to the sentences most relevant to the query, or dropped. Leave empty to return full texts.",
+        )
+        metrics_port: Optional[int] = Field(
+            default=None,
+            description="Port to serve Prometheus metrics (per-stage latency, candidate counts, cache hits) on /metrics. Leave empty to disable.",
+        )
+        debug_timings: bool = Field(
+            default=False,
+            description="Emit a status event with the per-stage timing breakdown after each search.",
+        )
+        result_cache_size: int = Field(
+            default=256,
+            description="Maximum number of cached search results (ranked nodes and scores). Set to 0 to disable.",
+        )
+        result_cache_ttl: float = Field(
+            default=600.0,
+            description="Seconds to keep cached search results. Results are also invalidated when the Qdrant collection changes.",
+        )
 
     def __init__(self) -> None:
         """
@@ -433,26 +2633,634 @@ class Pipeline:
         if self.valves.ollama_base_url and self.valves.deepinfra_api_key:
             raise ValueError("Do not set both Ollama base URL and DeepInfra API key")
         self.citation = False
-        self._index = None
-        self._last_config = None
+        self._snapshot: Optional[IndexSnapshot] = None
+        self._snapshot_valves: Optional[BaseModel] = None
         self._lock = asyncio.Lock()
+        self._models = ModelRegistry()
+        self._query_cache = TTLCache(
+            maxsize=self.valves.query_cache_size, ttl=self.valves.query_cache_ttl
+        )
+        self._result_cache = TTLCache(
+            maxsize=self.valves.result_cache_size, ttl=self.valves.result_cache_ttl
+        )
+        self._collection_version = None
+        self._collection_checked_at = 0.0
+        self._metrics = SearchMetrics()
+        self._indexed_collections = set()
+        self._embedded_qdrant = EmbeddedQdrant()
+        self._state: StateBackend = MemoryStateBackend()
+        self._state_url: Optional[str] = None
+        self._metrics_server = MetricsServer(self._render_metrics)
+        self._tracer = get_tracer()
+        self._warmup_task: Optional[asyncio.Task] = None
+        self._warmup_timings: Dict[str, float] = {}
+
+    async def on_startup(self) -> None:
+        """
+        Warm up the index and models in the background before the first query.
+        """
+        self._warmup_task = asyncio.create_task(self._warmup())
 
-    async def retrieve_documents(
+    async def _warmup(self) -> None:
+        """
+        Import LlamaIndex, load the tokenizer, build the index and models
+        (loading the sparse model) and run a dummy embedding, recording how
+        long each took. Blocking steps run in threads so that requests
+        arriving meanwhile are not stalled.
+        """
+        timings = self._warmup_timings
+        stage = "imports"
+        try:
+            start = time.perf_counter()
+            await asyncio.to_thread(import_llama_index)
+            timings[stage] = time.perf_counter() - start
+
+            if self.valves.max_result_tokens:
+                stage = "tokenizer"
+                start = time.perf_counter()
+                await asyncio.to_thread(get_token_counter)
+                timings[stage] = time.perf_counter() - start
+
+            stage = "index"
+            start = time.perf_counter()
+            snapshot = await self._refresh_snapshot()
+            timings[stage] = time.perf_counter() - start
+
+            stage = "sparse_model"
+            start = time.perf_counter()
+            await asyncio.to_thread(
+                snapshot.index.vector_store._sparse_query_fn, ["warmup"]
+            )
+            timings[stage] = time.perf_counter() - start
+
+            stage = "embedding"
+            start = time.perf_counter()
+            await asyncio.to_thread(snapshot.embed_model.get_query_embedding, "warmup")
+            timings[stage] = time.perf_counter() - start
+        except Exception as e:
+            logger.warning(f"Document search warmup failed at {stage}: {e}")
+        logger.info(
+            "Document search warmup: "
+            + ", ".join(
+                f"{name} {seconds * 1000:.0f} ms" for name, seconds in timings.items()
+            )
+        )
+
+    async def on_shutdown(self) -> None:
+        """
+        Close pooled HTTP connections and the Qdrant client once requests drain.
+        """
+        if self._warmup_task and not self._warmup_task.done():
+            self._warmup_task.cancel()
+        async with self._lock:
+            if self._snapshot:
+                await self._snapshot.retire()
+            self._snapshot = None
+            self._snapshot_valves = None
+            await self._metrics_server.stop()
+            await self._embedded_qdrant.close()
+            await self._state.close()
+
+    async def on_valves_updated(self) -> None:
+        """
+        Make the next request compare the valves against the current snapshot.
+        """
+        self._snapshot_valves = None
+
+    def _render_metrics(self) -> str:
+        return self._metrics.render(
+            {"query": self._query_cache, "result": self._result_cache},
+            gauges={
+                **self._state.stats(),
+                **{
+                    f"warmup_{name}_seconds": seconds
+                    for name, seconds in self._warmup_timings.items()
+                },
+            },
+        )
+
+    @contextlib.asynccontextmanager
+    async def _use_snapshot(self) -> AsyncIterator[IndexSnapshot]:
+        """
+        Hold the current index snapshot for the duration of a request.
+        """
+        # Fast path without locking: Open WebUI replaces the valves object on
+        # update, so an identity check detects unchanged valves.
+        snapshot = self._snapshot
+        if snapshot is None or self._snapshot_valves is not self.valves:
+            snapshot = await self._refresh_snapshot()
+        snapshot.acquire()
+        try:
+            yield snapshot
+        except Exception as e:
+            if snapshot.peer_url and is_connection_error(e):
+                # The worker serving the embedded store went away; the next
+                # request reconnects, taking over the store if it is free.
+                logger.warning(
+                    f"Embedded Qdrant store at {snapshot.peer_url} is unreachable"
+                )
+                await self._drop_snapshot(snapshot)
+            raise
+        finally:
+            await snapshot.release()
+
+    async def _drop_snapshot(self, snapshot: IndexSnapshot) -> None:
+        """
+        Retire snapshot so that the next request rebuilds it, unless it was
+        already replaced.
+        """
+        async with self._lock:
+            if self._snapshot is snapshot:
+                self._snapshot = None
+                self._snapshot_valves = None
+                await snapshot.retire()
+
+    async def _refresh_snapshot(self) -> IndexSnapshot:
+        """
+        Return a snapshot for the current valves, rebuilding it if they changed.
+        """
+        # Lock required so concurrent requests rebuild the snapshot only once.
+        async with self._lock:
+            valves = self.valves
+            snapshot = self._snapshot
+            if snapshot is not None and self._snapshot_valves is valves:
+                return snapshot
+            config = valves.model_dump_json()
+            if snapshot is None or snapshot.config != config:
+                # Copy the valves so the snapshot is unaffected by later updates.
+                valves_copy = valves.model_copy(deep=True)
+                state = self._state
+                if valves_copy.state_backend_url != self._state_url:
+                    # Opened before anything is swapped, so that a failure
+                    # (e.g., redis not installed) is retried by the next
+                    # request instead of leaving the old backend in place.
+                    state = get_state_backend(valves_copy.state_backend_url)
+                try:
+                    qdrant_url = valves_copy.qdrant_url
+                    aclient = server_url = None
+                    parsed_url = urlparse(qdrant_url, scheme="file")
+                    if parsed_url.scheme == "file":
+                        # Embedded stores stay open across snapshots (and may
+                        # be served by another worker).
+                        aclient, server_url = await self._embedded_qdrant.connect(
+                            parsed_url.path, valves_copy.embedded_qdrant_port
+                        )
+                        qdrant_url = server_url or qdrant_url
+                    # Loading the models (and, for remote stores, checking
+                    # the collection) blocks, so it runs in a thread.
+                    embed_model = await asyncio.to_thread(
+                        self._models.get_embedding_model, valves_copy
+                    )
+                    reranker_model = None
+                    if valves_copy.reranker_model:
+                        reranker_model = await asyncio.to_thread(
+                            self._models.get_reranker_model, valves_copy
+                        )
+                    index = await asyncio.to_thread(
+                        get_vector_index,
+                        qdrant_url=qdrant_url,
+                        qdrant_collection_name=valves_copy.qdrant_collection_name,
+                        embedding_model=valves_copy.embedding_model,
+                        embedding_query_instruction=valves_copy.embedding_query_instruction,
+                        ollama_base_url=valves_copy.ollama_base_url,
+                        deepinfra_api_key=valves_copy.deepinfra_api_key,
+                        qdrant_api_key=valves_copy.qdrant_api_key,
+                        embed_model=embed_model,
+                        aclient=aclient,
+                    )
+                    await self._metrics_server.start(valves_copy.metrics_port)
+                except BaseException:
+                    if state is not self._state:
+                        await state.close()
+                    raise
+
+                # Every step that can fail has succeeded; swap in the new state.
+                self._query_cache.configure(
+                    maxsize=valves_copy.query_cache_size,
+                    ttl=valves_copy.query_cache_ttl,
+                )
+                cache_sparse_queries(index.vector_store, self._query_cache)
+                self._result_cache.configure(
+                    maxsize=valves_copy.result_cache_size,
+                    ttl=valves_copy.result_cache_ttl,
+                )
+                self._result_cache.clear()
+                self._collection_version = None
+                http_pool = HTTPSessionPool(
+                    limit=valves_copy.http_pool_limit,
+                    keepalive_timeout=valves_copy.http_keepalive_timeout,
+                    request_timeout=valves_copy.http_request_timeout,
+                )
+                self._snapshot = IndexSnapshot(
+                    version=snapshot.version + 1 if snapshot else 1,
+                    valves=valves_copy,
+                    config=config,
+                    index=index,
+                    http_pool=http_pool,
+                    # Shared embedded clients are closed by _embedded_qdrant.
+                    owns_client=aclient is None,
+                    embed_model=embed_model,
+                    reranker_model=reranker_model,
+                    peer_url=server_url if aclient is None else None,
+                )
+                if snapshot:
+                    # Closes the old clients once in-flight requests drain.
+                    await snapshot.retire()
+                if state is not self._state:
+                    # Citation state is not migrated; open conversations
+                    # restart their numbering.
+                    await self._state.close()
+                    self._state = state
+                    self._state_url = valves_copy.state_backend_url
+                if valves_copy.create_payload_indexes:
+                    await self._ensure_payload_indexes(self._snapshot)
+            self._snapshot_valves = valves
+            return self._snapshot
+
+    async def _ensure_payload_indexes(self, snapshot: IndexSnapshot) -> None:
+        """
+        Create missing payload indexes once per collection.
+        """
+        key = (snapshot.valves.qdrant_url, snapshot.valves.qdrant_collection_name)
+        if key in self._indexed_collections:
+            return
+        try:
+            created = await ensure_payload_indexes(
+                snapshot.index.vector_store._aclient,
+                snapshot.valves.qdrant_collection_name,
+            )
+        except Exception as e:
+            # Searches still work without the indexes, only slower.
+            logger.warning(f"Could not create Qdrant payload indexes: {e}")
+            return
+        if created:
+            logger.info(f"Created Qdrant payload indexes: {', '.join(created)}")
+        self._indexed_collections.add(key)
+
+    async def _get_collection_version(self, snapshot: IndexSnapshot) -> Optional[tuple]:
+        """
+        Return a fingerprint of the Qdrant collection contents.
+
+        The fingerprint is refreshed at most every COLLECTION_VERSION_TTL
+        seconds, and the result cache is cleared whenever it changes.
+        """
+        if self._result_cache.maxsize <= 0:
+            return None
+        now = time.monotonic()
+        if (
+            self._collection_version is None
+            or now - self._collection_checked_at >= COLLECTION_VERSION_TTL
+        ):
+            info = await snapshot.index.vector_store._aclient.get_collection(
+                snapshot.valves.qdrant_collection_name
+            )
+            version = (info.points_count, info.segments_count)
+            if version != self._collection_version:
+                self._result_cache.clear()
+                self._collection_version = version
+            self._collection_checked_at = now
+        return self._collection_version
+
+    async def _embed_queries(
+        self, snapshot: IndexSnapshot, queries: List[str], timer: SearchTimer
+    ) -> List[List[float]]:
+        """
+        Return dense embeddings for queries, computing cache misses concurrently.
+        """
+        # Reuse the dense query embedding when the same query repeats,
+        # e.g., across iterations of an agentic RAG loop.
+        normalized_queries = [normalize_query(query) for query in queries]
+        keys = [
+            (
+                "dense",
+                snapshot.valves.embedding_model,
+                snapshot.valves.embedding_query_instruction,
+                normalized_query,
+            )
+            for normalized_query in normalized_queries
+        ]
+        embeddings = [self._query_cache.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        shared_keys = {}
+        if missing and self._state.shared and snapshot.valves.share_query_cache:
+            # Check the shared backend before computing local misses.
+            shared_keys = {
+                i: "embedding:" + hashlib.sha256(repr(keys[i]).encode()).hexdigest()
+                for i in missing
+            }
+            values = await self._state.get_many(list(shared_keys.values()))
+            for i, value in zip(missing, values):
+                if value is not None:
+                    embeddings[i] = array.array("d", value).tolist()
+                    self._query_cache.set(keys[i], embeddings[i])
+            missing = [i for i in missing if embeddings[i] is None]
+        if missing:
+            with timer.stage("embed"):
+                computed = await asyncio.gather(
+                    *(
+                        snapshot.embed_model.aget_query_embedding(normalized_queries[i])
+                        for i in missing
+                    )
+                )
+                for i, embedding in zip(missing, computed):
+                    embeddings[i] = embedding
+                    self._query_cache.set(keys[i], embedding)
+                if shared_keys:
+                    await self._state.set_many(
+                        {
+                            shared_keys[i]: array.array("d", embeddings[i]).tobytes()
+                            for i in missing
+                        },
+                        ttl=snapshot.valves.query_cache_ttl,
+                    )
+                if len(missing) > 1 and self._query_cache.maxsize > 0:
+                    # Encode the sparse (BM25) vectors of all new queries in one
+                    # batch; the cached encoder then serves each retriever call.
+                    snapshot.index.vector_store._sparse_query_fn(
+                        [queries[i] for i in missing]
+                    )
+        return embeddings
+
+    async def _search_many(
+        self,
+        snapshot: IndexSnapshot,
+        queries: List[str],
+        top_k: int,
+        filters: Optional[models.Filter],
+        emit_status: Callable[[str], Any],
+        timer: SearchTimer,
+    ) -> List[List[NodeWithScore]]:
+        """
+        Search for each query concurrently, serving repeats from the result cache.
+        """
+        from llama_index.core.schema import NodeWithScore
+
+        filters_key = filters.model_dump_json() if filters else None
+
+        # Serve repeat questions from the result cache, skipping both the
+        # hybrid search and the reranker. Citations are assigned afterwards,
+        # per conversation.
+        collection_version = await self._get_collection_version(snapshot)
+        result_keys = [
+            (
+                normalize_query(query),
+                filters_key,
+                top_k,
+                snapshot.config_hash,
+                collection_version,
+            )
+            for query in queries
+        ]
+        cached_results = [self._result_cache.get(key) for key in result_keys]
+        results = [
+            (
+                [NodeWithScore(node=node, score=score) for node, score in cached]
+                if cached is not None
+                else None
+            )
+            for cached in cached_results
+        ]
+
+        missing = [i for i, nodes in enumerate(results) if nodes is None]
+        if missing:
+            embeddings = await self._embed_queries(
+                snapshot, [queries[i] for i in missing], timer
+            )
+            searched = await asyncio.gather(
+                *(
+                    self._search(
+                        snapshot,
+                        queries[i],
+                        top_k,
+                        filters,
+                        emit_status,
+                        embedding=embedding,
+                        timer=timer,
+                    )
+                    for i, embedding in zip(missing, embeddings)
+                )
+            )
+            for i, nodes in zip(missing, searched):
+                results[i] = nodes
+                self._result_cache.set(
+                    result_keys[i], [(node.node, node.score) for node in nodes]
+                )
+        return results
+
+    async def _get_citation_index(
+        self, __metadata__: Optional[Dict[str, Any]]
+    ) -> "CitationIndex":
+        """
+        Return the conversation's CitationIndex, creating it if needed.
+        """
+        if not __metadata__:
+            return CitationIndex()
+        # No await between the check and the set, so concurrent requests
+        # cannot create separate CitationIndex instances (which would cause
+        # citation_id collisions), without waiting on the snapshot lock.
+        citation_index = __metadata__.get("document_search_citation_index")
+        if citation_index is None:
+            chat_id = __metadata__.get("chat_id")
+            message_id = __metadata__.get("message_id")
+            if chat_id and message_id:
+                # Numbered in the shared state backend, so requests for the
+                # same message may hit different workers.
+                citation_index = CitationIndex(self._state, f"{chat_id}:{message_id}")
+            else:
+                citation_index = CitationIndex()
+            __metadata__["document_search_citation_index"] = citation_index
+        return citation_index
+
+    async def _drop_cited(
+        self, results: List[List[NodeWithScore]], citation_index: CitationIndex
+    ) -> List[List[NodeWithScore]]:
+        """
+        Remove the nodes already cited in the chat, which are left out of the
+        output, from each list of results.
+        """
+        cited = await citation_index.get_cited(
+            [node.id_ for nodes in results for node in nodes]
+        )
+        if not cited:
+            return results
+        return [[node for node in nodes if node.id_ not in cited] for nodes in results]
+
+    async def _expand_context(
+        self,
+        snapshot: IndexSnapshot,
+        nodes: List[NodeWithScore],
+        citation_index: CitationIndex,
+        cleaned_texts: Dict[str, str],
+        timer: SearchTimer,
+    ) -> Dict[str, str]:
+        """
+        Return the texts of the nodes with neighboring chunks not already cited.
+
+        Expansion is best effort: on failure the nodes keep their own texts.
+        """
+        with timer.stage("expand"):
+            try:
+                neighbor_ids = [
+                    neighbor_id
+                    for node in nodes
+                    for neighbor_id in get_neighbor_ids(node)
+                    if neighbor_id
+                ]
+                cited = await citation_index.get_cited(neighbor_ids)
+                texts = await expand_context(
+                    snapshot.index.vector_store, nodes, cited, cleaned_texts
+                )
+            except Exception as e:
+                logger.warning(f"Could not expand search results with context: {e}")
+                timer.count("expansion_errors")
+                return {}
+        timer.count("expanded_results", len(texts))
+        return texts
+
+    async def _report_packing(
         self,
+        num_nodes: int,
+        num_packed: int,
+        num_trimmed: int,
+        max_tokens: int,
+        emit_status: Callable[..., Any],
+        timer: SearchTimer,
+    ) -> None:
+        """
+        Count and report the results trimmed or dropped to fit the token budget.
+        """
+        num_dropped = num_nodes - num_packed
+        timer.count("trimmed_results", num_trimmed)
+        timer.count("dropped_results", num_dropped)
+        if num_trimmed or num_dropped:
+            await emit_status(
+                f"Trimmed {num_trimmed} and dropped {num_dropped} of {num_nodes} "
+                f"results to fit the {max_tokens} token budget.",
+                done=True,
+            )
+
+    async def _search(
+        self,
+        snapshot: IndexSnapshot,
         query: str,
-        top_k: int = RESULTS_DEFAULT,
-        file_name: Optional[str] = None,
-        __metadata__: Optional[Dict[str, Any]] = None,
-        __event_emitter__: Optional[Callable[[Dict[str, Any]], Any]] = None,
+        top_k: int,
+        filters: Optional[models.Filter],
+        emit_status: Callable[[str], Any],
+        embedding: List[float],
+        timer: SearchTimer,
+    ) -> List[NodeWithScore]:
+        """
+        Run hybrid retrieval for a query and rerank the candidates if configured.
+        """
+        from llama_index.core import QueryBundle
+
+        # Determine number of candidates to retrieve if reranking.
+        if snapshot.valves.reranker_model:
+            num_candidates = max(
+                CANDIDATES_MIN,
+                min(CANDIDATES_MAX, top_k * CANDIDATES_PER_RESULT),
+            )
+        else:
+            num_candidates = top_k
+
+        search_params = build_search_params(
+            hnsw_ef=snapshot.valves.search_hnsw_ef,
+            exact=snapshot.valves.search_exact,
+            quantization_rescore=snapshot.valves.quantization_rescore,
+            quantization_oversampling=snapshot.valves.quantization_oversampling,
+        )
+
+        with timer.stage("retrieve"):
+            if snapshot.valves.retrieval_engine == "projected":
+                nodes = await retrieve_projected(
+                    snapshot.index.vector_store,
+                    query,
+                    embedding,
+                    top_k=num_candidates,
+                    filters=filters,
+                    search_params=search_params,
+                )
+            elif snapshot.valves.retrieval_engine == "qdrant":
+                nodes = await retrieve_native(
+                    snapshot.index.vector_store,
+                    query,
+                    embedding,
+                    top_k=num_candidates,
+                    filters=filters,
+                    fusion=snapshot.valves.hybrid_fusion,
+                    search_params=search_params,
+                )
+            elif snapshot.valves.retrieval_engine == "llamaindex":
+                # Create a query engine with hybrid search mode and async execution.
+                retriever = snapshot.index.as_retriever(
+                    vector_store_query_mode="hybrid",
+                    similarity_top_k=num_candidates,
+                    vector_store_kwargs={
+                        "qdrant_filters": filters,
+                        "search_params": search_params,
+                    },
+                    use_async=True,
+                )
+                nodes = await retriever.aretrieve(
+                    QueryBundle(query_str=query, embedding=embedding)
+                )
+            else:
+                raise ValueError(
+                    f"Unknown retrieval engine: {snapshot.valves.retrieval_engine}"
+                )
+        timer.count("candidates", len(nodes))
+
+        # Rerank if reranker model is configured.
+        if snapshot.valves.reranker_model and nodes:
+            with timer.stage("rerank"):
+                if snapshot.valves.reranker_adaptive:
+                    await emit_status(
+                        f"Reranking top {top_k} from up to {len(nodes)} candidates..."
+                    )
+                    nodes = await rerank_in_waves(
+                        nodes,
+                        query=query,
+                        top_k=top_k,
+                        get_ranker=lambda top_n: self._models.get_reranker(
+                            snapshot.valves,
+                            top_n=top_n,
+                            http_pool=snapshot.http_pool,
+                            model=snapshot.reranker_model,
+                        ),
+                        wave_size=snapshot.valves.reranker_wave_size,
+                        min_hybrid_score=snapshot.valves.reranker_min_hybrid_score,
+                    )
+                else:
+                    await emit_status(
+                        f"Reranking top {top_k} from {len(nodes)} candidates..."
+                    )
+                    ranker = self._models.get_reranker(
+                        snapshot.valves,
+                        top_n=top_k,
+                        http_pool=snapshot.http_pool,
+                        model=snapshot.reranker_model,
+                    )
+                    nodes = await ranker.apostprocess_nodes(nodes, query_str=query)
+
+        return nodes
+
+    async def _retrieve(
+        self,
+        queries: List[str],
+        top_k: int,
+        file_name: Optional[Union[str, List[str]]],
+        file_type: Optional[str],
+        modified_after: Optional[str],
+        modified_before: Optional[str],
+        __metadata__: Optional[Dict[str, Any]],
+        __event_emitter__: Optional[Callable[[Dict[str, Any]], Any]],
+        batch: bool = False,
     ) -> str:
         """
-        Retrieve relevant documents from the Qdrant vector store using hybrid search.
+        Search for the queries and return the results as JSON: the documents
+        of a single query, or the documents per query of a batch.
 
-        :param query: Natural language search query
-        :param top_k: Number of top documents to return
-        :param file_name: Filename to optionally filter results by
-        :param __metadata__: Injected by Open WebUI with information about the chat
-        :param __event_emitter__: Injected by Open WebUI to send events to the frontend
+        Documents matching more than one query are returned only once.
         """
 
         async def emit_status(
@@ -474,97 +3282,299 @@ class Pipeline:
         if top_k < RESULTS_MIN or top_k > RESULTS_MAX:
             return f"Error: top_k must be between {RESULTS_MIN} and {RESULTS_MAX}."
 
-        if file_name:
-            parsed_filters = build_filters(file_name)
-        else:
-            parsed_filters = None
+        if batch and (not queries or len(queries) > BATCH_QUERIES_MAX):
+            return f"Error: queries must contain between 1 and {BATCH_QUERIES_MAX} queries."
 
-        filter_desc = f" in {file_name}" if file_name else ""
-        await emit_status(f"Searching{filter_desc} for: {query}")
+        filter_desc = describe_filters(
+            file_name, file_type, modified_after, modified_before
+        )
+        if batch:
+            await emit_status(f"Searching{filter_desc} for {len(queries)} queries...")
+        else:
+            await emit_status(f"Searching{filter_desc} for: {queries[0]}")
 
+        timer = SearchTimer(self._tracer)
+        timer.count("requests")
         try:
-            # Cache and reuse the VectorStoreIndex object.
-            # Lock required to prevent concurrent requests from closing/recreating
-            # the index simultaneously, which could cause client errors.
-            async with self._lock:
-                current_config = self.valves.model_dump_json()
-                if not self._index or self._last_config != current_config:
-                    if self._index:
-                        await self._index.vector_store._aclient.close()
-                    self._index = get_vector_index(
-                        qdrant_url=self.valves.qdrant_url,
-                        qdrant_collection_name=self.valves.qdrant_collection_name,
-                        embedding_model=self.valves.embedding_model,
-                        embedding_query_instruction=self.valves.embedding_query_instruction,
-                        ollama_base_url=self.valves.ollama_base_url,
-                        deepinfra_api_key=self.valves.deepinfra_api_key,
-                        qdrant_api_key=self.valves.qdrant_api_key,
-                    )
-                    self._last_config = current_config
-
-            # Determine number of candidates to retrieve if reranking.
-            if self.valves.reranker_model:
-                num_candidates = max(
-                    CANDIDATES_MIN,
-                    min(CANDIDATES_MAX, top_k * CANDIDATES_PER_RESULT),
-                )
-            else:
-                num_candidates = top_k
-
-            # Create a query engine with hybrid search mode and async execution.
-            retriever = self._index.as_retriever(
-                vector_store_query_mode="hybrid",
-                similarity_top_k=num_candidates,
-                filters=parsed_filters,
-                use_async=True,
+            filters = build_filters(
+                file_name, file_type, modified_after, modified_before
             )
-
-            nodes = await retriever.aretrieve(query)
-
-            # Rerank if reranker model is configured.
-            if self.valves.reranker_model and nodes:
-                await emit_status(
-                    f"Reranking top {top_k} from {len(nodes)} candidates..."
+            async with self._use_snapshot() as snapshot:
+                # The request reads its settings from its snapshot and holds
+                # it until the output is ready.
+                valves = snapshot.valves
+                results = await self._search_many(
+                    snapshot, queries, top_k, filters, emit_status, timer
                 )
-                ranker = get_reranker(
-                    top_n=top_k,
-                    reranker_model_name=self.valves.reranker_model,
-                    ollama_base_url=self.valves.ollama_base_url,
-                    deepinfra_api_key=self.valves.deepinfra_api_key,
-                )
-                nodes = await ranker.apostprocess_nodes(nodes, query_str=query)
 
-            if nodes:
-                await emit_status("Search complete.", done=True, hidden=True)
-            else:
-                await emit_status("No documents found.", done=True)
-                return "No relevant documents found for the query."
-
-            if __metadata__:
-                # Lock required to prevent concurrent requests from creating
-                # separate CitationIndex instances, which would cause citation_id
-                # collisions and loss of citation state across the conversation.
-                if "document_search_citation_index" not in __metadata__:
-                    async with self._lock:
-                        if "document_search_citation_index" not in __metadata__:
-                            __metadata__["document_search_citation_index"] = (
-                                CitationIndex()
+                # Deduplicate across queries, keeping each node under the query
+                # where it scored highest (the earlier query on ties).
+                best = {}
+                for i, nodes in enumerate(results):
+                    for node in nodes:
+                        node_id = node.node.node_id
+                        if node_id not in best or (node.score or 0.0) > (
+                            best[node_id].score or 0.0
+                        ):
+                            best[node_id] = node
+                results = [
+                    [node for node in nodes if best[node.node.node_id] is node]
+                    for nodes in results
+                ]
+
+                if any(results):
+                    await emit_status("Search complete.", done=True, hidden=True)
+                else:
+                    await emit_status("No documents found.", done=True)
+                    if batch:
+                        return "No relevant documents found for the queries."
+                    return "No relevant documents found for the query."
+
+                citation_index = await self._get_citation_index(__metadata__)
+                if valves.max_result_tokens or valves.expand_context:
+                    # Expand and pack only the nodes that will be output.
+                    results = await self._drop_cited(results, citation_index)
+
+                # Each node's text is cleaned once for both the citation and the
+                # tool output.
+                cleaned_texts: Dict[str, str] = {}
+                # Output texts replacing the cleaned node texts.
+                texts: Dict[str, str] = {}
+                if valves.expand_context:
+                    texts = await self._expand_context(
+                        snapshot,
+                        [node for nodes in results for node in nodes],
+                        citation_index,
+                        cleaned_texts,
+                        timer,
+                    )
+                # Pack before citing so that dropped nodes are not cited. A batch
+                # splits the budget evenly between its queries.
+                if valves.max_result_tokens:
+                    max_tokens = valves.max_result_tokens // len(queries)
+                    num_nodes = sum(len(nodes) for nodes in results)
+                    trimmed_texts: Dict[str, str] = {}
+                    with timer.stage("pack"):
+                        packed_results = []
+                        for query, nodes in zip(queries, results):
+                            packed, trimmed = pack_results(
+                                nodes, query, max_tokens, cleaned_texts, texts
                             )
-                citation_index = __metadata__["document_search_citation_index"]
-            else:
-                citation_index = CitationIndex()
-
-            documents = []
-            for node in nodes:
-                citation_id = await citation_index.add_if_not_exists(
-                    node, __event_emitter__
-                )
-                if citation_id:
-                    documents.append(clean_node(node, citation_id=citation_id))
+                            packed_results.append(packed)
+                            trimmed_texts.update(trimmed)
+                    results = packed_results
+                    await self._report_packing(
+                        num_nodes,
+                        sum(len(nodes) for nodes in results),
+                        len(trimmed_texts),
+                        valves.max_result_tokens,
+                        emit_status,
+                        timer,
+                    )
+                    texts.update(trimmed_texts)
 
-            return json.dumps(documents)
+                with timer.stage("cite"):
+                    citation_ids, emission = await citation_index.add_all_if_not_exists(
+                        [node for nodes in results for node in nodes],
+                        __event_emitter__,
+                        cleaned_texts,
+                    )
+                    cited_results = []
+                    start = 0
+                    for nodes in results:
+                        cited_results.append(
+                            [
+                                (node, citation_id)
+                                for node, citation_id in zip(
+                                    nodes, citation_ids[start : start + len(nodes)]
+                                )
+                                if citation_id
+                            ]
+                        )
+                        start += len(nodes)
+
+                # Citation events are sent while the output is serialized.
+                with timer.stage("serialize"):
+                    documents = [
+                        [
+                            clean_node(
+                                node, citation_id, cleaned_texts, texts.get(node.id_)
+                            )
+                            for node, citation_id in cited_nodes
+                        ]
+                        for cited_nodes in cited_results
+                    ]
+                    if batch:
+                        output = serialize_results(
+                            [
+                                QueryResults(query=query, documents=query_documents)
+                                for query, query_documents in zip(queries, documents)
+                            ]
+                        )
+                    else:
+                        output = serialize_results(documents[0])
+                timer.count("results", sum(len(nodes) for nodes in cited_results))
+
+                if emission:
+                    with timer.stage("emit"):
+                        await emission
+
+                if valves.debug_timings:
+                    await emit_status(f"Search timings: {timer.summary()}", done=True)
+                return output
 
         except Exception as e:
+            timer.count("errors")
             error_message = f"An error occurred during search: {e}"
             await emit_status(error_message, done=True, hidden=False)
-            return error_message
\ No newline at end of file
+            return error_message
+
+        finally:
+            self._metrics.observe(timer)
+
+    async def retrieve_documents(
+        self,
+        query: str,
+        top_k: int = RESULTS_DEFAULT,
+        file_name: Optional[Union[str, List[str]]] = None,
+        file_type: Optional[str] = None,
+        modified_after: Optional[str] = None,
+        modified_before: Optional[str] = None,
+        __metadata__: Optional[Dict[str, Any]] = None,
+        __event_emitter__: Optional[Callable[[Dict[str, Any]], Any]] = None,
+    ) -> str:
+        """
+        Retrieve relevant documents from the Qdrant vector store using hybrid search.
+
+        :param query: Natural language search query
+        :param top_k: Number of top documents to return
+        :param file_name: Filename or list of filenames to optionally filter results by
+        :param file_type: File type (MIME type) to optionally filter results by, e.g., "application/pdf"
+        :param modified_after: Optional earliest last modified date (YYYY-MM-DD)
+        :param modified_before: Optional latest last modified date (YYYY-MM-DD)
+        :param __metadata__: Injected by Open WebUI with information about the chat
+        :param __event_emitter__: Injected by Open WebUI to send events to the frontend
+        """
+        return await self._retrieve(
+            [query],
+            top_k,
+            file_name,
+            file_type,
+            modified_after,
+            modified_before,
+            __metadata__,
+            __event_emitter__,
+        )
+
+    async def retrieve_documents_batch(
+        self,
+        queries: List[str],
+        top_k: int = RESULTS_DEFAULT,
+        file_name: Optional[Union[str, List[str]]] = None,
+        file_type: Optional[str] = None,
+        modified_after: Optional[str] = None,
+        modified_before: Optional[str] = None,
+        __metadata__: Optional[Dict[str, Any]] = None,
+        __event_emitter__: Optional[Callable[[Dict[str, Any]], Any]] = None,
+    ) -> str:
+        """
+        Retrieve relevant documents for several related queries at once using hybrid search.
+        Documents matching more than one query are returned only once.
+
+        :param queries: List of natural language search queries
+        :param top_k: Number of top documents to return per query
+        :param file_name: Filename or list of filenames to optionally filter results by
+        :param file_type: File type (MIME type) to optionally filter results by, e.g., "application/pdf"
+        :param modified_after: Optional earliest last modified date (YYYY-MM-DD)
+        :param modified_before: Optional latest last modified date (YYYY-MM-DD)
+        :param __metadata__: Injected by Open WebUI with information about the chat
+        :param __event_emitter__: Injected by Open WebUI to send events to the frontend
+        """
+        return await self._retrieve(
+            queries,
+            top_k,
+            file_name,
+            file_type,
+            modified_after,
+            modified_before,
+            __metadata__,
+            __event_emitter__,
+            batch=True,
+        )
+
+
+def _loopback_host(host: str) -> str:
+    if not is_loopback_host(host):
+        raise argparse.ArgumentTypeError(
+            "the server has no authentication, use a loopback address"
+        )
+    return host
+
+
+async def _serve(args: argparse.Namespace) -> None:
+    sock = EmbeddedQdrantServer.bind(args.port, host=args.host)
+    if sock is None:
+        raise SystemExit(f"Port {args.port} is already in use.")
+    aclient = AsyncQdrantClient(path=urlparse(args.qdrant_url, scheme="file").path)
+    server = EmbeddedQdrantServer(aclient)
+    await server.start(sock)
+    print(f"Serving {args.qdrant_url} on http://{args.host}:{args.port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+        await aclient.close()
+
+
+async def _main(args: argparse.Namespace) -> None:
+    if args.command == "serve":
+        await _serve(args)
+        return
+    aclient = get_async_qdrant_client(args.qdrant_url, args.qdrant_api_key)
+    try:
+        if args.command == "normalize":
+            updated = await normalize_collection(
+                aclient, args.qdrant_collection_name, batch_size=args.batch_size
+            )
+            print(f"Normalized {updated} points.")
+        elif args.command == "quantize":
+            await quantize_collection(
+                aclient,
+                args.qdrant_collection_name,
+                method=args.method,
+                on_disk=args.on_disk,
+                dense_vector_name=args.dense_vector_name,
+            )
+            print(f"Updated quantization of {args.qdrant_collection_name}.")
+    finally:
+        await aclient.close()
+
+
+if __name__ == "__main__":
+    # Offline maintenance of the Qdrant collection, e.g.:
+    #   python document_search_pipeline.py normalize --qdrant-url http://qdrant:6333
+    #   python document_search_pipeline.py quantize --method scalar --on-disk
+    # or serve a local Qdrant directory to the workers:
+    #   python document_search_pipeline.py serve --qdrant-url ./qdrant_db --port 6335
+    parser = argparse.ArgumentParser(description="Document Search maintenance")
+    parser.add_argument("command", choices=["normalize", "quantize", "serve"])
+    parser.add_argument("--qdrant-url", default=Pipeline.Valves().qdrant_url)
+    parser.add_argument(
+        "--qdrant-collection-name", default=Pipeline.Valves().qdrant_collection_name
+    )
+    parser.add_argument("--qdrant-api-key", default=None)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument(
+        "--method", choices=["scalar", "binary", "none"], default="scalar"
+    )
+    parser.add_argument(
+        "--on-disk",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Store the original dense vectors on disk (or back in RAM).",
+    )
+    parser.add_argument("--dense-vector-name", default="text-dense")
+    parser.add_argument("--host", type=_loopback_host, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6335)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(parser.parse_args()))
\ No newline at end of file
@@ -0,0 +1,44 @@
+"""
+Tests of the text cleaning applied to search results.
+
+Run from this directory with the pipeline requirements and pytest installed:
+
+    python -m pytest
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "pipelines"))
+
+from document_search_pipeline import clean_text  # noqa: E402
+
+
+@pytest.mark.parametrize(
+    ("text", "expected"),
+    [
+        ("<b>Bold</b> text<br/>", "Bold text"),
+        ("a < b > c", "a < b > c"),
+        ("run `make` twice", "run make twice"),
+        ("see [1] and [2, 3].", "see and ."),
+        ("list [a, b]", "list [a, b]"),
+        ("a  b   c", "a b c"),
+        ("Contents.......... 5", "Contents... 5"),
+        ("Wait...", "Wait..."),
+        ("a\n\n\n\nb", "a\n\nb"),
+        ("a\n   \n\t\nb", "a\n\nb"),
+        ("  trimmed \n", "trimmed"),
+    ],
+)
+def test_clean_text(text, expected):
+    assert clean_text(text) == expected
+
+
+def test_clean_text_normalizes_after_removals():
+    # Whitespace left behind by removed backticks, tags and citation
+    # references is normalized like any other.
+    assert clean_text("a\n```\n\n```\nb") == "a\n\nb"
+    assert clean_text("a\n<p>\n\n</p>\nb") == "a\n\nb"
+    assert clean_text("x [1] [2] y") == "x y"
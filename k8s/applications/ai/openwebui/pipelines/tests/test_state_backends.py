@@ -0,0 +1,103 @@
+"""
+Tests of the citation state backends, with fakeredis standing in for Redis.
+
+Run from this directory with the pipeline requirements, pytest, fakeredis and
+lupa (for Lua scripting in fakeredis) installed:
+
+    python -m pytest
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "pipelines"))
+
+from document_search_pipeline import (  # noqa: E402
+    STATE_KEY_PREFIX,
+    MemoryStateBackend,
+    RedisStateBackend,
+)
+
+
+@pytest.fixture
+def redis_backends(monkeypatch):
+    """
+    Return a factory of Redis state backends that share one fake server,
+    like workers sharing a Redis instance.
+    """
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    import redis.asyncio
+
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis.asyncio,
+        "from_url",
+        lambda url: fakeredis.FakeAsyncRedis(server=server),
+    )
+    return lambda: RedisStateBackend("redis://localhost:6379/0", citation_ttl=60)
+
+
+def test_memory_claim_citation():
+    async def run():
+        backend = MemoryStateBackend()
+        assert await backend.claim_citation("chat", "a") == 1
+        assert await backend.claim_citation("chat", "b") == 2
+        assert await backend.claim_citation("chat", "a") is None
+        assert await backend.claim_citation("other", "a") == 1
+        assert await backend.is_cited("chat", ["a", "c"]) == [True, False]
+
+    asyncio.run(run())
+
+
+def test_redis_claim_citation(redis_backends):
+    async def run():
+        backend = redis_backends()
+        assert await backend.claim_citation("chat", "a") == 1
+        assert await backend.claim_citation("chat", "b") == 2
+        assert await backend.claim_citation("chat", "a") is None
+        assert await backend.claim_citation("other", "a") == 1
+        assert await backend.is_cited("chat", ["a", "c"]) == [True, False]
+        ttl = await backend._redis.ttl(f"{STATE_KEY_PREFIX}citations:chat")
+        assert 0 < ttl <= 60
+        await backend.close()
+
+    asyncio.run(run())
+
+
+def test_claim_citations(redis_backends):
+    async def run():
+        for backend in (MemoryStateBackend(), redis_backends()):
+            assert await backend.claim_citations("chat", ["a", "b", "a"]) == [
+                1,
+                2,
+                None,
+            ]
+            assert await backend.claim_citations("chat", ["c", "b"]) == [3, None]
+            assert await backend.claim_citations("chat", []) == []
+            await backend.close()
+
+    asyncio.run(run())
+
+
+def test_redis_concurrent_claims(redis_backends):
+    async def run():
+        workers = [redis_backends() for _ in range(4)]
+        node_ids = [f"node-{i}" for i in range(25)]
+        # Every worker claims every node concurrently.
+        results = await asyncio.gather(
+            *(
+                worker.claim_citation("chat", node_id)
+                for node_id in node_ids
+                for worker in workers
+            )
+        )
+        citation_ids = [citation_id for citation_id in results if citation_id]
+        assert sorted(citation_ids) == list(range(1, len(node_ids) + 1))
+        for worker in workers:
+            await worker.close()
+
+    asyncio.run(run())